@@ -1,7 +1,21 @@
 import requests
+import urllib3
 import arcpy
 import json
 import os
+import sys
+import sqlite3
+import subprocess
+import time
+import hashlib
+
+from decimal import Decimal
+from itertools import chain
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.tokenUtils import TokenUtils
+from utils.httpUtils import get_http_utils
 
 ######################################
 ## TO BE MODIFIED BEFORE PUBLISHING ##
@@ -13,15 +27,50 @@ ROOT_PATH = 'C:\\Users\\jeff9123\\Documents\\github\\MESA-GP\\AddFeatures'
 
 # CODE
 
+HTTP = None
+
+DEFAULT_RETRY_CODES = [500, 502, 503, 504]
+
+# whole batch errors from a gateway, the service may have committed the adds behind it
+AMBIGUOUS_BATCH_CODES = [502, 504]
+
+INTEGER_FIELD_TYPES = ['esriFieldTypeSmallInteger', 'esriFieldTypeInteger', 'esriFieldTypeBigInteger']
+FLOAT_FIELD_TYPES = ['esriFieldTypeSingle', 'esriFieldTypeDouble']
+STRING_FIELD_TYPES = ['esriFieldTypeString', 'esriFieldTypeGUID']
+SYSTEM_FIELD_TYPES = ['esriFieldTypeOID', 'esriFieldTypeGlobalID', 'esriFieldTypeGeometry']
+GEOMETRY_KEYS = {
+  'esriGeometryPoint': ['x'],
+  'esriGeometryMultipoint': ['points'],
+  'esriGeometryPolyline': ['paths', 'curvePaths'],
+  'esriGeometryPolygon': ['rings', 'curveRings']
+}
+
 def open_config():
   with open(os.path.join(ROOT_PATH, 'config.json')) as f:
     return json.load(f)
 
-def get_portal_token():
-  config = open_config()
-  portal_props = config['portal']
+# the pooled keep-alive client shared by every request this process makes
+def get_http():
+  global HTTP
+  if HTTP is None:
+    config = open_config()
+    HTTP = get_http_utils(config['http'] if 'http' in config else None)
+  return HTTP
 
+def log_connection_stats():
+  stats = get_http().get_connection_stats()
+  for host in stats:
+    arcpy.AddMessage('{0}: {1} requests over {2} connections ({3} reused)'.format(
+      host,
+      stats[host]['requests'],
+      stats[host]['connections'],
+      stats[host]['reused']
+    ))
+
+# request a new token from the portal, returns a (token, expires) pair
+def fetch_portal_token(portal_props):
   token = None
+  expires = None
   portal_url = portal_props['url']
 
   if 'username' in portal_props and 'password' in portal_props:
@@ -34,11 +83,11 @@ def get_portal_token():
         'f': 'json'
       }
 
-      req = requests.post(portal_url + '/sharing/rest/generateToken', data=payload, verify=False)
-      req_json = req.json()
+      req_json = get_http().post_json(portal_url + '/sharing/rest/generateToken', payload)
       token = req_json['token']
+      expires = TokenUtils.normalize_expires(req_json['expires'] if 'expires' in req_json else None)
     except (ValueError, KeyError):
-      return None
+      return None, None
   if 'client_id' in portal_props and 'refresh_token' in portal_props:
     try:
       payload = {
@@ -47,11 +96,11 @@ def get_portal_token():
         'grant_type': 'refresh_token'
       }
 
-      req = requests.post(portal_url + '/sharing/rest/oauth2/token', data=payload, verify=False)
-      req_json = req.json()
+      req_json = get_http().post_json(portal_url + '/sharing/rest/oauth2/token', payload)
       token = req_json['access_token']
+      expires = TokenUtils.normalize_expires(expires_in=req_json['expires_in'] if 'expires_in' in req_json else None)
     except (ValueError, KeyError):
-      return None
+      return None, None
   elif 'client_id' in portal_props and 'client_secret' in portal_props:
     try:
       payload = {
@@ -60,15 +109,35 @@ def get_portal_token():
         'grant_type': 'client_credentials'
       }
 
-      req = requests.post(portal_url + '/sharing/rest/oauth2/token', data=payload, verify=False)
-      req_json = req.json()
+      req_json = get_http().post_json(portal_url + '/sharing/rest/oauth2/token', payload)
       token = req_json['access_token']
+      expires = TokenUtils.normalize_expires(expires_in=req_json['expires_in'] if 'expires_in' in req_json else None)
     except (ValueError, KeyError):
-      return None
+      return None, None
+
+  return token, expires
 
-  return token
+# key a cached token by portal and the identity it was issued to (never by the secret)
+def get_portal_token_key(portal_props):
+  identity = ''
+  if 'client_id' in portal_props and ('refresh_token' in portal_props or 'client_secret' in portal_props):
+    identity = 'client_id:{}'.format(portal_props['client_id'])
+  elif 'username' in portal_props:
+    identity = 'username:{}'.format(portal_props['username'])
+  return '{0}|{1}'.format(portal_props['url'].rstrip('/'), identity)
 
-def add_features(service_url, add_features_params, token=None):
+# get a portal token through the shared on disk token cache, only going to the portal when it is about to expire
+def get_portal_token():
+  config = open_config()
+  portal_props = config['portal']
+  token_utils = TokenUtils(config['token_cache'] if 'token_cache' in config else None)
+  token_key = get_portal_token_key(portal_props)
+
+  # drop the cached token if a service rejects it
+  get_http().on_invalid_token = lambda: token_utils.invalidate(token_key)
+  return token_utils.get_token(token_key, lambda: fetch_portal_token(portal_props))
+
+def add_features(service_url, add_features_params, token=None, compress=False):
   payload = {
     'f': 'json'
   }
@@ -78,31 +147,797 @@ def add_features(service_url, add_features_params, token=None):
   
   payload['features'] = json.dumps(add_features_params)
 
-  req = requests.post(service_url + '/addFeatures', data=payload, verify=False)
-  req_json = req.json()
+  return get_http().post_json(service_url + '/addFeatures', payload, compress)
+
+# send adds, updates and deletes for one layer in a single applyEdits request
+def apply_edits(service_url, edits, token=None, compress=False):
+  payload = {
+    'f': 'json'
+  }
+
+  if token:
+    payload['token'] = token
+
+  for key in ['adds', 'updates']:
+    if key in edits and edits[key]:
+      payload[key] = json.dumps(edits[key])
+  if 'deletes' in edits and edits['deletes']:
+    deletes = edits['deletes']
+    if isinstance(deletes, list):
+      deletes = ','.join([str(oid) for oid in deletes])
+    payload['deletes'] = deletes
+  for key in ['gdbVersion', 'rollbackOnFailure', 'useGlobalIds', 'returnEditMoment']:
+    if key in edits:
+      payload[key] = edits[key] if isinstance(edits[key], str) else json.dumps(edits[key])
+
+  return get_http().post_json(service_url + '/applyEdits', payload, compress)
+
+# unescape the raw parameter text a piece at a time, holding back a trailing backslash
+# so an escaped quote split across two pieces is still replaced
+def iter_unescaped_text(raw_text, read_size=65536):
+  carry = ''
+  for idx in range(0, len(raw_text), read_size):
+    piece = carry + raw_text[idx:idx + read_size]
+    carry = ''
+    if piece.endswith('\\'):
+      carry = piece[-1]
+      piece = piece[:-1]
+    yield piece.replace('\\"', '"')
+  if carry:
+    yield carry
+
+# incrementally decode the features of a JSON array from pieces of text,
+# only holding the text of the feature currently being decoded
+# (as strict as json.loads: one comma between features, nothing but whitespace after the array)
+def iter_features(text_pieces):
+  decoder = json.JSONDecoder()
+  pieces = iter(text_pieces)
+  buffer = ''
+  pos = 0
+  # what may come next: 'array', 'first' (a feature or ']'), 'feature', 'separator' (',' or ']') or 'end'
+  expect = 'array'
+
+  while True:
+    while pos < len(buffer) and buffer[pos] in ' \t\r\n':
+      pos += 1
+
+    if pos >= len(buffer):
+      piece = next(pieces, None)
+      if piece is None:
+        break
+      buffer = piece
+      pos = 0
+      continue
+
+    char = buffer[pos]
+    if expect == 'array':
+      if char != '[':
+        raise ValueError('addFeaturesParams must be a JSON array of features')
+      expect = 'first'
+      pos += 1
+      continue
+
+    if expect == 'end':
+      raise ValueError('addFeaturesParams has extra data after the JSON array')
+
+    if expect == 'separator':
+      if char == ',':
+        expect = 'feature'
+      elif char == ']':
+        expect = 'end'
+      else:
+        raise ValueError('addFeaturesParams JSON array is missing a comma between features')
+      pos += 1
+      continue
+
+    if expect == 'first' and char == ']':
+      expect = 'end'
+      pos += 1
+      continue
+
+    try:
+      feature, pos = decoder.raw_decode(buffer, pos)
+    except ValueError:
+      # the feature may just be cut off at the end of the buffer, so read more before failing
+      # (at least doubling what is buffered, so a large feature is only decoded a few times)
+      pending = [buffer[pos:]]
+      pending_size = len(pending[0])
+      while pending_size < 2 * len(pending[0]):
+        piece = next(pieces, None)
+        if piece is None:
+          break
+        pending.append(piece)
+        pending_size += len(piece)
+      if len(pending) == 1:
+        raise
+      buffer = ''.join(pending)
+      pos = 0
+      continue
+
+    expect = 'separator'
+    yield feature
+
+  if expect != 'end':
+    raise ValueError('addFeaturesParams JSON array is not terminated')
+
+# decode every feature once and throw it away, so malformed input is rejected before anything is written
+# (only one feature is held at a time, like the submitting pass)
+def validate_features(raw_text):
+  feature_cnt = 0
+  for feature in iter_features(iter_unescaped_text(raw_text)):
+    if not isinstance(feature, dict):
+      raise ValueError('addFeaturesParams must be a JSON array of features')
+    feature_cnt += 1
+  return feature_cnt
+
+# group features into lists of at most batch_size features (or one list if batch_size is not set)
+def iter_batches(features, batch_size=None):
+  batch = []
+  for feature in features:
+    batch.append(feature)
+    if batch_size and len(batch) >= batch_size:
+      yield batch
+      batch = []
+  if batch:
+    yield batch
+
+# find the config.json properties for a service, if any were set
+def get_service_props(config, service_url):
+  services_props = config['services'] if 'services' in config else {}
+  for url in services_props:
+    if url.rstrip('/').lower() == service_url.rstrip('/').lower():
+      return services_props[url]
+  return {}
+
+# snap x/y values to the tolerance grid, rounding to the tolerance's decimals so the JSON stays short
+def quantize_vertex(vertex, tolerance, decimals):
+  return [round(round(value / tolerance) * tolerance, decimals) for value in vertex[:2]] + vertex[2:]
+
+# quantize the vertices of a path, ring or multipoint and drop repeated vertices
+# (a part that would collapse below min_vertices is kept as it was)
+def quantize_part(part, tolerance, decimals, min_vertices):
+  quantized = []
+  for vertex in part:
+    vertex = quantize_vertex(vertex, tolerance, decimals)
+    if not quantized or quantized[-1] != vertex:
+      quantized.append(vertex)
+  if len(quantized) < min_vertices:
+    return part
+  return quantized
+
+def quantize_geometry(geometry, tolerance):
+  # the decimals the tolerance itself is written with (0.25 -> 2), so every grid value survives the rounding
+  decimals = max(0, -Decimal(str(tolerance)).normalize().as_tuple().exponent)
+  if 'x' in geometry and 'y' in geometry and geometry['x'] is not None and geometry['y'] is not None:
+    geometry['x'], geometry['y'] = quantize_vertex([geometry['x'], geometry['y']], tolerance, decimals)
+  if 'points' in geometry:
+    geometry['points'] = quantize_part(geometry['points'], tolerance, decimals, 1)
+  if 'paths' in geometry:
+    geometry['paths'] = [quantize_part(path, tolerance, decimals, 2) for path in geometry['paths']]
+  if 'rings' in geometry:
+    geometry['rings'] = [quantize_part(ring, tolerance, decimals, 4) for ring in geometry['rings']]
+  return geometry
+
+# quantize feature geometries to the service tolerance, counting the geometry bytes saved
+def quantize_features(features, tolerance, stats):
+  for feature in features:
+    if 'geometry' in feature and feature['geometry']:
+      original_size = len(json.dumps(feature['geometry']))
+      feature['geometry'] = quantize_geometry(feature['geometry'], tolerance)
+      stats['original_bytes'] += original_size
+      stats['saved_bytes'] += original_size - len(json.dumps(feature['geometry']))
+    yield feature
+
+####################
+### SCHEMA STUFF ###
+####################
+
+def get_schema_cache_path(schema_props, service_url):
+  cache_dir = schema_props['path'] if 'path' in schema_props else 'schema_cache'
+  if not os.path.isabs(cache_dir):
+    cache_dir = os.path.join(ROOT_PATH, cache_dir)
+  if not os.path.exists(cache_dir):
+    os.makedirs(cache_dir, exist_ok=True)
+  url_hash = hashlib.sha1(service_url.rstrip('/').lower().encode('utf-8')).hexdigest()
+  return os.path.join(cache_dir, '{}.json'.format(url_hash))
+
+def fetch_layer_schema(service_url, token=None):
+  payload = {
+    'f': 'json'
+  }
+
+  if token:
+    payload['token'] = token
+
+  return get_http().post_json(service_url, payload)
+
+# get the layer's fields and geometry type, from the on disk cache while it is younger than ttl_seconds
+def get_layer_schema(service_url, token=None, schema_props=None):
+  schema_props = schema_props or {}
+  ttl_seconds = schema_props['ttl_seconds'] if 'ttl_seconds' in schema_props else 3600
+  cache_path = get_schema_cache_path(schema_props, service_url)
+
+  try:
+    with open(cache_path) as f:
+      schema = json.load(f)
+    if time.time() - schema['fetched'] < ttl_seconds:
+      return index_schema(schema)
+  except (OSError, ValueError, KeyError):
+    pass
+
+  try:
+    layer_json = fetch_layer_schema(service_url, token)
+  except (requests.exceptions.RequestException, ValueError):
+    return None
+  if 'fields' not in layer_json:
+    return None
+
+  schema = {
+    'fields': layer_json['fields'],
+    'geometryType': layer_json['geometryType'] if 'geometryType' in layer_json else None,
+    'fetched': time.time()
+  }
+
+  # write to a temp file first so concurrent jobs never read a half written schema
+  temp_path = '{0}.{1}.tmp'.format(cache_path, os.getpid())
+  try:
+    with open(temp_path, 'w') as f:
+      json.dump(schema, f)
+    os.replace(temp_path, cache_path)
+  except OSError:
+    pass
+  return index_schema(schema)
+
+# look up fields by lower case name and work out the required fields once per schema
+def index_schema(schema):
+  schema['fields_by_name'] = {}
+  schema['required_fields'] = []
+  for field in schema['fields']:
+    schema['fields_by_name'][field['name'].lower()] = field
+    is_required = 'nullable' in field and not field['nullable'] and ('editable' not in field or field['editable'])
+    has_default = 'defaultValue' in field and field['defaultValue'] is not None
+    if is_required and not has_default and field['type'] not in SYSTEM_FIELD_TYPES:
+      schema['required_fields'].append(field)
+  return schema
+
+def coerce_value(value, field):
+  field_type = field['type']
+  if field_type in INTEGER_FIELD_TYPES:
+    if isinstance(value, bool):
+      raise ValueError('{} is not an integer'.format(value))
+    if isinstance(value, float):
+      if not value.is_integer():
+        raise ValueError('{} is not an integer'.format(value))
+      return int(value)
+    try:
+      return int(value)
+    except ValueError:
+      number = float(value)
+      if not number.is_integer():
+        raise
+      return int(number)
+  if field_type in FLOAT_FIELD_TYPES:
+    if isinstance(value, bool):
+      raise ValueError('{} is not a number'.format(value))
+    return float(value)
+  if field_type in STRING_FIELD_TYPES:
+    value = str(value)
+    if 'length' in field and field['length'] and len(value) > field['length']:
+      raise ValueError('longer than {} characters'.format(field['length']))
+    return value
+  if field_type == 'esriFieldTypeDate' and not isinstance(value, str):
+    return int(value)
+  return value
+
+def check_domain(value, field):
+  domain = field['domain'] if 'domain' in field else None
+  if not domain or value is None:
+    return
+  if domain['type'] == 'codedValue':
+    if value not in [coded_value['code'] for coded_value in domain['codedValues']]:
+      raise ValueError('{} is not in the coded value domain'.format(value))
+  elif domain['type'] == 'range':
+    if value < domain['range'][0] or value > domain['range'][1]:
+      raise ValueError('{} is outside the range domain'.format(value))
+
+# validate a feature against the layer schema, coercing attribute values in place
+# returns an error description, or None when the feature is valid
+def validate_feature(feature, schema):
+  attributes = feature['attributes'] if 'attributes' in feature and feature['attributes'] else {}
+  fields = schema['fields_by_name']
+
+  for name in attributes:
+    if name.lower() not in fields or attributes[name] is None:
+      continue
+    field = fields[name.lower()]
+    if field['type'] in SYSTEM_FIELD_TYPES:
+      continue
+    try:
+      attributes[name] = coerce_value(attributes[name], field)
+      check_domain(attributes[name], field)
+    except (ValueError, TypeError) as e:
+      return 'Invalid value for field {0}: {1}'.format(field['name'], e)
+
+  attribute_names = [name.lower() for name in attributes if attributes[name] is not None]
+  for field in schema['required_fields']:
+    if field['name'].lower() not in attribute_names:
+      return 'Missing required field {}'.format(field['name'])
+
+  geometry = feature['geometry'] if 'geometry' in feature else None
+  geometry_type = schema['geometryType']
+  if geometry and geometry_type in GEOMETRY_KEYS:
+    if not any([key in geometry for key in GEOMETRY_KEYS[geometry_type]]):
+      return 'Geometry does not match the layer geometry type {}'.format(geometry_type)
+  return None
+
+# expand a batch response into exactly one addResult per feature the batch carried
+# (a batch that failed as a whole gets one failed addResult per feature, a response that does not
+# account for every feature gets unknown ones, since some of its adds may have been committed)
+def get_add_results(batch_resp, feature_count):
+  if 'addResults' in batch_resp and len(batch_resp['addResults']) == feature_count:
+    return batch_resp['addResults']
+  if 'error' not in batch_resp:
+    return get_unknown_results(feature_count, 'Outcome unknown: Invalid addFeatures response')
+
+  error = batch_resp['error']
+  add_results = []
+  for idx in range(feature_count):
+    add_results.append({
+      'objectId': None,
+      'success': False,
+      'error': error
+    })
+  return add_results
+
+# the request never reached the service (no connection could be made), so it is safe to send again
+def is_pre_send_failure(e):
+  if isinstance(e, requests.exceptions.ConnectTimeout):
+    return True
+  if isinstance(e, requests.exceptions.ConnectionError) and e.args:
+    reason = getattr(e.args[0], 'reason', e.args[0])
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
+  return False
+
+# results for features whose adds may or may not have been committed (read timeouts, gateway errors),
+# reported as unknown rather than resubmitted, so they are never added twice
+def get_unknown_results(feature_count, description):
+  return [{
+    'objectId': None,
+    'success': False,
+    'unknown': True,
+    'error': {'code': None, 'description': description}
+  } for idx in range(feature_count)]
+
+def request_add_results(service_url, features, token=None, compress=False):
+  if not features:
+    return []
+  try:
+    batch_resp = add_features(service_url, features, token, compress)
+  except requests.exceptions.RequestException as e:
+    if is_pre_send_failure(e):
+      batch_resp = {'error': {'code': 503, 'description': str(e)}}
+    else:
+      return get_unknown_results(len(features), 'Outcome unknown: {}'.format(e))
+  except ValueError as e:
+    # an unreadable response (e.g. a gateway error page) says nothing about what was committed
+    return get_unknown_results(len(features), 'Outcome unknown: {}'.format(e))
+
+  if 'error' in batch_resp and batch_resp['error']['code'] in AMBIGUOUS_BATCH_CODES:
+    return get_unknown_results(len(features), 'Outcome unknown: {}'.format(batch_resp['error']))
+  return get_add_results(batch_resp, len(features))
+
+def is_retryable(add_result, retry_codes):
+  if 'success' in add_result and add_result['success']:
+    return False
+  if 'unknown' in add_result and add_result['unknown']:
+    return False
+  return 'error' in add_result and add_result['error'] and add_result['error']['code'] in retry_codes
+
+# submit one batch, then resubmit only the features that failed with a transient error,
+# backing off exponentially (capped at max_delay seconds) between attempts
+def submit_batch(service_url, batch, token=None, compress=False, retry_props=None, schema=None):
+  retry_props = retry_props or {}
+  max_retries = retry_props['max_retries'] if 'max_retries' in retry_props else 3
+  base_delay = retry_props['base_delay'] if 'base_delay' in retry_props else 1
+  max_delay = retry_props['max_delay'] if 'max_delay' in retry_props else 30
+  retry_codes = retry_props['codes'] if 'codes' in retry_props else DEFAULT_RETRY_CODES
+
+  # reject invalid features locally, only the valid ones are sent
+  add_results = [None] * len(batch)
+  valid = []
+  for idx, feature in enumerate(batch):
+    error = validate_feature(feature, schema) if schema else None
+    if error:
+      add_results[idx] = {
+        'objectId': None,
+        'success': False,
+        'error': {'code': 400, 'description': error}
+      }
+    else:
+      valid.append(idx)
+
+  for idx, add_result in zip(valid, request_add_results(service_url, [batch[idx] for idx in valid], token, compress)):
+    add_results[idx] = add_result
+  attempts = [1] * len(batch)
+
+  for attempt in range(max_retries):
+    failed = [idx for idx, add_result in enumerate(add_results) if is_retryable(add_result, retry_codes)]
+    if not failed:
+      break
+
+    time.sleep(min(max_delay, base_delay * (2 ** attempt)))
+    retry_results = request_add_results(service_url, [batch[idx] for idx in failed], token, compress)
+    for idx, add_result in zip(failed, retry_results):
+      add_results[idx] = add_result
+      attempts[idx] += 1
+
+  for add_result, attempt_cnt in zip(add_results, attempts):
+    if attempt_cnt > 1:
+      add_result['attempts'] = attempt_cnt
+  return add_results
+
+# submit batches over a bounded pool of workers, pulling the next batch only when there is room for it
+def submit_feature_batches(service_url, batches, token=None, max_workers=4, compress=False, retry_props=None, schema=None):
+  merged = {
+    'addResults': []
+  }
+
+  with ThreadPoolExecutor(max_workers=max_workers) as executor:
+    in_flight = deque()
+    for batch in batches:
+      in_flight.append(executor.submit(submit_batch, service_url, batch, token, compress, retry_props, schema))
+      if len(in_flight) >= max_workers * 2:
+        merged['addResults'] += in_flight.popleft().result()
+
+    while in_flight:
+      merged['addResults'] += in_flight.popleft().result()
+
+  # final per feature status
+  succeeded = len([add_result for add_result in merged['addResults'] if add_result['success']])
+  unknown = len([add_result for add_result in merged['addResults'] if 'unknown' in add_result])
+  merged['summary'] = {
+    'succeeded': succeeded,
+    'failed': len(merged['addResults']) - succeeded - unknown,
+    'unknown': unknown,
+    'resubmitted': len([add_result for add_result in merged['addResults'] if 'attempts' in add_result])
+  }
+  return merged
+
+####################
+### LAYERS STUFF ###
+####################
+
+# quantize the adds and updates of an edit session in place
+def quantize_edits(edits, tolerance, stats):
+  for key in ['adds', 'updates']:
+    if key in edits and edits[key]:
+      edits[key] = list(quantize_features(edits[key], tolerance, stats))
+  return edits
+
+# group the edits of a multi layer request ({"layers": [{"url": "", "adds": [], "updates": [], "deletes": []}]})
+# by layer url, keeping the order the layers first appear in
+def group_layer_edits(layers):
+  grouped = {}
+  for layer in layers:
+    layer_url = layer['url'].rstrip('/')
+    if layer_url not in grouped:
+      grouped[layer_url] = {'adds': [], 'updates': [], 'deletes': []}
+    layer_edits = grouped[layer_url]
+
+    for key in layer:
+      if key in ['adds', 'updates'] and layer[key]:
+        layer_edits[key] += layer[key]
+      elif key == 'deletes' and layer[key]:
+        deletes = layer[key]
+        if isinstance(deletes, str):
+          deletes = [oid.strip() for oid in deletes.split(',') if oid.strip()]
+        layer_edits[key] += deletes
+      elif key not in ['url', 'adds', 'updates', 'deletes']:
+        layer_edits[key] = layer[key]
+  return grouped
+
+# adds only layers go through the batched addFeatures path, anything else
+# (including adds with applyEdits options like rollbackOnFailure) through applyEdits
+def submit_layer_edits(layer_url, layer_edits, token, config):
+  batching_props = config['batching'] if 'batching' in config else {}
+  chunk_size = batching_props['chunk_size'] if 'chunk_size' in batching_props else None
+  max_workers = batching_props['max_workers'] if 'max_workers' in batching_props else 4
+  compress = config['gzip_requests'] if 'gzip_requests' in config else False
+  retry_props = config['retry'] if 'retry' in config else {}
+  schema_props = config['schema_cache'] if 'schema_cache' in config else {}
+
+  apply_edits_options = [key for key in layer_edits if key not in ['adds', 'updates', 'deletes']]
+  if layer_edits['updates'] or layer_edits['deletes'] or apply_edits_options:
+    return apply_edits(layer_url, layer_edits, token, compress)
+
+  schema = None
+  if schema_props and schema_props['enabled']:
+    schema = get_layer_schema(layer_url, token, schema_props)
+  return submit_feature_batches(layer_url, iter_batches(layer_edits['adds'], chunk_size), token, max_workers, compress, retry_props, schema)
+
+# submit every layer's edits concurrently with one token and the shared client, results keyed by layer url
+def submit_multi_layer_edits(grouped, token, config):
+  batching_props = config['batching'] if 'batching' in config else {}
+  max_layer_workers = batching_props['max_layer_workers'] if 'max_layer_workers' in batching_props else 4
+
+  layer_resps = {}
+  with ThreadPoolExecutor(max_workers=max_layer_workers) as executor:
+    futures = {}
+    for layer_url in grouped:
+      futures[layer_url] = executor.submit(submit_layer_edits, layer_url, grouped[layer_url], token, config)
+
+    for layer_url in grouped:
+      try:
+        layer_resps[layer_url] = futures[layer_url].result()
+      except (requests.exceptions.RequestException, ValueError) as e:
+        layer_resps[layer_url] = {'error': {'code': 503, 'description': str(e)}}
+  return layer_resps
+
+####################
+#### SPOOL STUFF ###
+####################
 
-  if 'error' in req_json:
-    if req_json['error']['code'] == 498:
-      del payload['token']
-      req = requests.post(service_url + '/addFeatures', data=payload, verify=False)
-      req_json = req.json()
-  return req_json
+def get_spool_path(spool_props):
+  spool_path = spool_props['path'] if 'path' in spool_props else 'spool.sqlite'
+  if not os.path.isabs(spool_path):
+    spool_path = os.path.join(ROOT_PATH, spool_path)
+  return spool_path
+
+# open (and create if needed) the local edit journal
+# (autocommit connection, transactions are started explicitly)
+def open_spool(spool_path):
+  conn = sqlite3.connect(spool_path, timeout=60, isolation_level=None)
+  conn.execute('PRAGMA journal_mode=WAL')
+  conn.execute(
+    'CREATE TABLE IF NOT EXISTS edits ('
+    'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+    'service_url TEXT NOT NULL, '
+    'feature TEXT NOT NULL, '
+    "state TEXT NOT NULL DEFAULT 'pending', "
+    'lease_until REAL, '
+    'attempts INTEGER NOT NULL DEFAULT 0, '
+    'error TEXT, '
+    'created REAL NOT NULL)'
+  )
+  conn.execute('CREATE INDEX IF NOT EXISTS edits_by_state ON edits (state, service_url, id)')
+  conn.execute('CREATE TABLE IF NOT EXISTS flusher (id INTEGER PRIMARY KEY, lease_until REAL NOT NULL)')
+  return conn
+
+# write incoming features to the journal, committing one batch at a time
+def spool_features(spool_path, service_url, features, batch_size=1000):
+  conn = open_spool(spool_path)
+  spooled = 0
+  try:
+    for batch in iter_batches(features, batch_size):
+      now = time.time()
+      conn.execute('BEGIN IMMEDIATE')
+      conn.executemany(
+        'INSERT INTO edits (service_url, feature, created) VALUES (?, ?, ?)',
+        [(service_url, json.dumps(feature), now) for feature in batch]
+      )
+      conn.execute('COMMIT')
+      spooled += len(batch)
+  finally:
+    conn.close()
+  return spooled
+
+# take (or renew) the single flusher lease, returns False if another flusher holds it
+def acquire_flusher_lease(conn, lease_seconds, renew=False):
+  now = time.time()
+  conn.execute('BEGIN IMMEDIATE')
+  row = conn.execute('SELECT lease_until FROM flusher WHERE id = 1').fetchone()
+  if row and row[0] > now and not renew:
+    conn.execute('ROLLBACK')
+    return False
+  conn.execute('INSERT OR REPLACE INTO flusher (id, lease_until) VALUES (1, ?)', (now + lease_seconds,))
+  conn.execute('COMMIT')
+  return True
+
+# lease the oldest pending edits of one service, including edits whose lease ran out
+# (a flusher that crashed mid batch leaves those behind, so they are delivered again).
+# When nothing is left the flusher lease is released in the same transaction, so edits
+# spooled after that point are picked up by the next flusher that is launched
+def claim_spooled_edits(conn, lease_seconds, batch_size):
+  now = time.time()
+  claimable = "(state = 'pending' OR (state = 'inflight' AND lease_until < ?))"
+  conn.execute('BEGIN IMMEDIATE')
+  try:
+    row = conn.execute('SELECT service_url FROM edits WHERE {} ORDER BY id LIMIT 1'.format(claimable), (now,)).fetchone()
+    if row is None:
+      conn.execute('DELETE FROM flusher WHERE id = 1')
+      conn.execute('COMMIT')
+      return None, []
+
+    service_url = row[0]
+    rows = conn.execute(
+      'SELECT id, feature, attempts FROM edits WHERE service_url = ? AND {} ORDER BY id LIMIT ?'.format(claimable),
+      (service_url, now, batch_size)
+    ).fetchall()
+    conn.executemany(
+      "UPDATE edits SET state = 'inflight', lease_until = ? WHERE id = ?",
+      [(now + lease_seconds, edit_row[0]) for edit_row in rows]
+    )
+    conn.execute('COMMIT')
+  except:
+    conn.execute('ROLLBACK')
+    raise
+  return service_url, rows
+
+# record the outcome of a flushed batch: delivered edits leave the journal,
+# transient failures go back to pending until max_attempts, the rest are kept as failed
+def settle_spooled_edits(conn, rows, add_results, retry_codes, max_attempts):
+  delivered = []
+  retry = []
+  failed = []
+  unknown = []
+  for edit_row, add_result in zip(rows, add_results):
+    if add_result['success']:
+      delivered.append((edit_row[0],))
+    elif 'unknown' in add_result:
+      # left for an operator to check against the service, flushing it again could add it twice
+      unknown.append((json.dumps(add_result['error']), edit_row[0]))
+    elif is_retryable(add_result, retry_codes) and edit_row[2] + 1 < max_attempts:
+      retry.append((edit_row[0],))
+    else:
+      failed.append((json.dumps(add_result['error'] if 'error' in add_result else None), edit_row[0]))
+
+  conn.execute('BEGIN IMMEDIATE')
+  conn.executemany('DELETE FROM edits WHERE id = ?', delivered)
+  conn.executemany("UPDATE edits SET state = 'pending', lease_until = NULL, attempts = attempts + 1 WHERE id = ?", retry)
+  conn.executemany("UPDATE edits SET state = 'failed', lease_until = NULL, attempts = attempts + 1, error = ? WHERE id = ?", failed)
+  conn.executemany("UPDATE edits SET state = 'unknown', lease_until = NULL, attempts = attempts + 1, error = ? WHERE id = ?", unknown)
+  conn.execute('COMMIT')
+  return len(delivered)
+
+# drain the journal in large coalesced addFeatures batches
+def flush_spool(config, token=None):
+  spool_props = config['spool'] if 'spool' in config else {}
+  batching_props = config['batching'] if 'batching' in config else {}
+  retry_props = config['retry'] if 'retry' in config else {}
+  flush_batch_size = spool_props['flush_batch_size'] if 'flush_batch_size' in spool_props else 5000
+  lease_seconds = spool_props['lease_seconds'] if 'lease_seconds' in spool_props else 600
+  max_attempts = spool_props['max_attempts'] if 'max_attempts' in spool_props else 5
+  chunk_size = batching_props['chunk_size'] if 'chunk_size' in batching_props else None
+  max_workers = batching_props['max_workers'] if 'max_workers' in batching_props else 4
+  compress = config['gzip_requests'] if 'gzip_requests' in config else False
+  retry_codes = retry_props['codes'] if 'codes' in retry_props else DEFAULT_RETRY_CODES
+  schema_props = config['schema_cache'] if 'schema_cache' in config else {}
+  schemas = {}
+
+  conn = open_spool(get_spool_path(spool_props))
+  flushed = 0
+  try:
+    if not acquire_flusher_lease(conn, lease_seconds):
+      return flushed
+
+    while True:
+      service_url, rows = claim_spooled_edits(conn, lease_seconds, flush_batch_size)
+      if not rows:
+        break
+
+      if schema_props and schema_props['enabled'] and service_url not in schemas:
+        schemas[service_url] = get_layer_schema(service_url, token, schema_props)
+      schema = schemas[service_url] if service_url in schemas else None
+
+      features = [json.loads(edit_row[1]) for edit_row in rows]
+      add_features_resp = submit_feature_batches(service_url, iter_batches(features, chunk_size), token, max_workers, compress, retry_props, schema)
+      flushed += settle_spooled_edits(conn, rows, add_features_resp['addResults'], retry_codes, max_attempts)
+      acquire_flusher_lease(conn, lease_seconds, True)
+  finally:
+    conn.close()
+  return flushed
+
+# start a detached flusher process so the GP request can return right away
+def launch_flusher(spool_props):
+  python_exe = os.path.join(sys.exec_prefix, 'python.exe')
+  if 'python_executable' in spool_props:
+    python_exe = spool_props['python_executable']
+  elif not os.path.exists(python_exe):
+    python_exe = sys.executable
+
+  creationflags = 0
+  if os.name == 'nt':
+    creationflags = subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP
+  subprocess.Popen(
+    [python_exe, os.path.abspath(__file__), '--flush'],
+    stdin=subprocess.DEVNULL,
+    stdout=subprocess.DEVNULL,
+    stderr=subprocess.DEVNULL,
+    close_fds=True,
+    creationflags=creationflags
+  )
+
+def flush():
+  config = open_config()
+  flushed = flush_spool(config, get_portal_token())
+  print('Flushed {} spooled edits'.format(flushed))
+  log_connection_stats()
 
 def main():
   in_add_features_params = arcpy.GetParameter(0) # in add features params
-  in_add_features_params = in_add_features_params.replace('\\"', '"')
+  in_service_url = arcpy.GetParameter(1)
+
+  config = open_config()
+  batching_props = config['batching'] if 'batching' in config else {}
+  chunk_size = batching_props['chunk_size'] if 'chunk_size' in batching_props else None
+  max_workers = batching_props['max_workers'] if 'max_workers' in batching_props else 4
+  compress = config['gzip_requests'] if 'gzip_requests' in config else False
+  retry_props = config['retry'] if 'retry' in config else {}
+  spool_props = config['spool'] if 'spool' in config else {}
+  schema_props = config['schema_cache'] if 'schema_cache' in config else {}
+
+  service_props = get_service_props(config, in_service_url)
+  tolerance = service_props['tolerance'] if 'tolerance' in service_props else None
+  quantize_stats = {'original_bytes': 0, 'saved_bytes': 0}
+
+  text_pieces = iter_unescaped_text(in_add_features_params)
+  first_piece = next(text_pieces, '')
+  text_pieces = chain([first_piece], text_pieces)
+  is_edit_session = first_piece.lstrip().startswith('{')
+  is_spooled = not is_edit_session and spool_props and spool_props['enabled']
+
+  token = None
+  if not is_spooled:
+    token = get_portal_token()
+
+  # only the parameter parsing is blamed on the input, a failing service is reported as such
+  grouped = None
   try:
-    in_add_features_params = json.loads(in_add_features_params)
-  except:
+    if is_edit_session:
+      edits = json.loads(''.join(text_pieces))
+      if 'layers' in edits:
+        # edits for many layers are grouped per layer and submitted concurrently
+        grouped = group_layer_edits(edits['layers'])
+        for layer_url in grouped:
+          layer_props = get_service_props(config, layer_url)
+          if 'tolerance' in layer_props and layer_props['tolerance']:
+            quantize_edits(grouped[layer_url], layer_props['tolerance'], quantize_stats)
+      elif tolerance:
+        quantize_edits(edits, tolerance, quantize_stats)
+    else:
+      validate_features(in_add_features_params)
+  except ValueError:
     arcpy.SetParameter(2, 'Invalid addFeaturesParams JSON, try again')
     exit()
 
-  in_service_url = arcpy.GetParameter(1)
+  try:
+    if grouped is not None:
+      edits_resp = submit_multi_layer_edits(grouped, token, config)
+    elif is_edit_session:
+      # an edit session ({"adds": [], "updates": [], "deletes": []}) goes through applyEdits in one round trip
+      edits_resp = apply_edits(in_service_url, edits, token, compress)
+    else:
+      features = iter_features(text_pieces)
+      if tolerance:
+        features = quantize_features(features, tolerance, quantize_stats)
+      if is_spooled:
+        # journal the features and return, a background flusher sends them to the service
+        spooled = spool_features(get_spool_path(spool_props), in_service_url, features)
+        if 'launch_flusher' not in spool_props or spool_props['launch_flusher']:
+          launch_flusher(spool_props)
+        edits_resp = {'spooled': spooled}
+      else:
+        schema = None
+        if schema_props and schema_props['enabled']:
+          schema = get_layer_schema(in_service_url, token, schema_props)
+        edits_resp = submit_feature_batches(in_service_url, iter_batches(features, chunk_size), token, max_workers, compress, retry_props, schema)
+  except (requests.exceptions.RequestException, ValueError) as e:
+    # e.g. no connection, or a gateway error page instead of a JSON response
+    arcpy.SetParameter(2, json.dumps({'error': {'code': None, 'description': 'Could not submit the edits to the service: {}'.format(e)}}))
+    exit()
 
-  token = get_portal_token()
-  add_features_resp = add_features(in_service_url, in_add_features_params, token)
-  
-  arcpy.SetParameter(2, json.dumps(add_features_resp))
+  if quantize_stats['original_bytes']:
+    arcpy.AddMessage('Quantizing geometries saved {0} of {1} bytes ({2:.1f}%)'.format(
+      quantize_stats['saved_bytes'],
+      quantize_stats['original_bytes'],
+      quantize_stats['saved_bytes'] * 100 / quantize_stats['original_bytes']
+    ))
+
+  log_connection_stats()
+  arcpy.SetParameter(2, json.dumps(edits_resp))
 
 if __name__ == '__main__':
-  main()
\ No newline at end of file
+  if '--flush' in sys.argv:
+    flush()
+  else:
+    main()
\ No newline at end of file
@@ -0,0 +1,118 @@
+import gzip
+import json
+import os
+import sys
+import threading
+import types
+import unittest
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+# main.py only needs arcpy for the GP parameters, none of which are used here
+sys.modules.setdefault('arcpy', types.ModuleType('arcpy'))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+
+import main
+from utils.httpUtils import HttpUtils
+
+# stand-in feature service layer that records every request and answers applyEdits
+class StandInLayer(BaseHTTPRequestHandler):
+  def do_POST(self):
+    body = self.rfile.read(int(self.headers['Content-Length']))
+    if self.headers.get('Content-Encoding') == 'gzip':
+      body = gzip.decompress(body)
+    form = {key: values[0] for key, values in parse_qs(body.decode('utf-8')).items()}
+    self.server.requests.append({
+      'path': self.path,
+      'gzip': self.headers.get('Content-Encoding') == 'gzip',
+      'form': form
+    })
+
+    if 'token' in form and form['token'] in self.server.invalid_tokens:
+      response = {'error': {'code': 498, 'message': 'Invalid token.'}}
+    elif self.path.endswith('/applyEdits'):
+      adds = json.loads(form['adds']) if 'adds' in form else []
+      updates = json.loads(form['updates']) if 'updates' in form else []
+      deletes = form['deletes'].split(',') if 'deletes' in form else []
+      response = {
+        'addResults': [{'objectId': 100 + idx, 'success': True} for idx in range(len(adds))],
+        'updateResults': [{'objectId': update['attributes']['OBJECTID'], 'success': True} for update in updates],
+        'deleteResults': [{'objectId': int(oid), 'success': True} for oid in deletes]
+      }
+    else:
+      response = {'error': {'code': 400, 'message': 'Unexpected request'}}
+
+    data = json.dumps(response).encode('utf-8')
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def log_message(self, format, *args):
+    pass
+
+class ApplyEditsTest(unittest.TestCase):
+  EDITS = {
+    'adds': [{'attributes': {'NAME': 'a'}, 'geometry': {'x': 1, 'y': 2}}, {'attributes': {'NAME': 'b'}}],
+    'updates': [{'attributes': {'OBJECTID': 7, 'NAME': 'c'}}],
+    'deletes': [3, 4]
+  }
+
+  def setUp(self):
+    self.server = ThreadingHTTPServer(('127.0.0.1', 0), StandInLayer)
+    self.server.requests = []
+    self.server.invalid_tokens = []
+    threading.Thread(target=self.server.serve_forever, daemon=True).start()
+    self.layer_url = 'http://127.0.0.1:{}/FeatureServer/0'.format(self.server.server_address[1])
+
+    main.HTTP = HttpUtils({'connect_timeout': 5, 'read_timeout': 5})
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+    main.HTTP = None
+
+  def test_edit_session_is_one_apply_edits_request(self):
+    resp = main.apply_edits(self.layer_url, dict(self.EDITS), 'good')
+
+    self.assertEqual(len(self.server.requests), 1)
+    request = self.server.requests[0]
+    self.assertEqual(request['path'], '/FeatureServer/0/applyEdits')
+    self.assertFalse(request['gzip'])
+    self.assertEqual(json.loads(request['form']['adds']), self.EDITS['adds'])
+    self.assertEqual(json.loads(request['form']['updates']), self.EDITS['updates'])
+    self.assertEqual(request['form']['deletes'], '3,4')
+    self.assertEqual(request['form']['token'], 'good')
+
+    self.assertEqual([result['objectId'] for result in resp['addResults']], [100, 101])
+    self.assertEqual([result['objectId'] for result in resp['updateResults']], [7])
+    self.assertEqual([result['objectId'] for result in resp['deleteResults']], [3, 4])
+
+  def test_gzip_body_carries_the_same_form(self):
+    resp = main.apply_edits(self.layer_url, dict(self.EDITS), 'good', compress=True)
+
+    request = self.server.requests[0]
+    self.assertTrue(request['gzip'])
+    self.assertEqual(json.loads(request['form']['adds']), self.EDITS['adds'])
+    self.assertEqual(request['form']['deletes'], '3,4')
+    self.assertEqual(len(resp['addResults']), 2)
+
+  def test_invalid_token_is_dropped_and_retried(self):
+    self.server.invalid_tokens.append('expired')
+    invalidated = []
+    main.HTTP.on_invalid_token = lambda: invalidated.append(True)
+
+    resp = main.apply_edits(self.layer_url, dict(self.EDITS), 'expired', compress=True)
+
+    self.assertEqual(len(self.server.requests), 2)
+    self.assertEqual(self.server.requests[0]['form']['token'], 'expired')
+    self.assertNotIn('token', self.server.requests[1]['form'])
+    self.assertTrue(self.server.requests[1]['gzip'])
+    self.assertEqual(invalidated, [True])
+    self.assertNotIn('error', resp)
+    self.assertEqual(len(resp['addResults']), 2)
+
+if __name__ == '__main__':
+  unittest.main()
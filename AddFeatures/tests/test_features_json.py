@@ -0,0 +1,30 @@
+import json
+import os
+import sys
+import types
+import unittest
+
+# main.py only needs arcpy for the GP parameters, none of which are used here
+sys.modules.setdefault('arcpy', types.ModuleType('arcpy'))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+
+import main
+
+class FeaturesJsonTest(unittest.TestCase):
+  def test_accepts_what_json_loads_accepts(self):
+    for text in ['[]', ' [ ] ', '[{}]', '[{}, {"a": [1, 2]}] \n', '[\n{"attributes": {"NAME": "a"}}\n,\n{}\n]']:
+      self.assertEqual(main.validate_features(text), len(json.loads(text)), text)
+
+  def test_rejects_what_json_loads_rejects(self):
+    for text in ['[{},,{}]', '[{} {}]', '[{}] junk', '[{}][]', '[,{}]', '[{},]', '[{}', '{}', '[1]']:
+      with self.assertRaises(ValueError, msg=text):
+        main.validate_features(text)
+
+  def test_features_split_across_pieces(self):
+    features = [{'attributes': {'NAME': 'x' * 5000, 'IDX': idx}} for idx in range(50)]
+    text = json.dumps(features)
+    decoded = list(main.iter_features(main.iter_unescaped_text(text, 777)))
+    self.assertEqual(decoded, features)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,19 @@
+import os
+import unittest
+
+ROOT_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir, os.path.pardir))
+
+# helpers each tool ships its own copy of, so either one publishes on its own
+SHARED_HELPERS = ['httpUtils.py', 'lockUtils.py', 'tokenUtils.py']
+
+class SharedHelpersTest(unittest.TestCase):
+  def test_both_tools_ship_identical_copies(self):
+    for helper in SHARED_HELPERS:
+      with open(os.path.join(ROOT_PATH, 'AddFeatures', 'utils', helper), 'rb') as f:
+        add_features_copy = f.read()
+      with open(os.path.join(ROOT_PATH, 'ExportReport', 'utils', helper), 'rb') as f:
+        export_report_copy = f.read()
+      self.assertEqual(add_features_copy, export_report_copy, 'AddFeatures/utils/{0} and ExportReport/utils/{0} differ'.format(helper))
+
+if __name__ == '__main__':
+  unittest.main()
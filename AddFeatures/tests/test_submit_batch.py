@@ -0,0 +1,61 @@
+import os
+import sys
+import types
+import unittest
+
+# main.py only needs arcpy for the GP parameters, none of which are used here
+sys.modules.setdefault('arcpy', types.ModuleType('arcpy'))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+
+import main
+
+RETRY_PROPS = {'max_retries': 2, 'base_delay': 0}
+
+class SubmitBatchTest(unittest.TestCase):
+  def setUp(self):
+    self.add_features = main.add_features
+    self.requests = []
+    self.responses = []
+
+  def tearDown(self):
+    main.add_features = self.add_features
+
+  # stand-in for the addFeatures request, answering with the queued responses in order
+  def stub_service(self, *responses):
+    self.responses = list(responses)
+
+    def add_features(service_url, features, token=None, compress=False):
+      self.requests.append(len(features))
+      return self.responses.pop(0)
+    main.add_features = add_features
+
+  def test_short_response_is_unknown_and_not_resubmitted(self):
+    self.stub_service({'addResults': [{'objectId': 1, 'success': True}]})
+
+    add_results = main.submit_batch('layer', [{}, {}, {}], retry_props=RETRY_PROPS)
+
+    self.assertEqual(self.requests, [3])
+    self.assertTrue(all(add_result['unknown'] for add_result in add_results))
+
+  def test_gateway_timeout_is_unknown_and_not_resubmitted(self):
+    self.stub_service({'error': {'code': 504, 'description': 'Gateway Timeout'}})
+
+    add_results = main.submit_batch('layer', [{}, {}], retry_props=RETRY_PROPS)
+
+    self.assertEqual(self.requests, [2])
+    self.assertTrue(all(add_result['unknown'] for add_result in add_results))
+
+  def test_transient_feature_errors_are_resubmitted(self):
+    self.stub_service(
+      {'addResults': [{'objectId': 1, 'success': True}, {'objectId': None, 'success': False, 'error': {'code': 503}}]},
+      {'addResults': [{'objectId': 2, 'success': True}]}
+    )
+
+    add_results = main.submit_batch('layer', [{}, {}], retry_props=RETRY_PROPS)
+
+    self.assertEqual(self.requests, [2, 1])
+    self.assertEqual([add_result['objectId'] for add_result in add_results], [1, 2])
+    self.assertEqual(add_results[1]['attempts'], 2)
+
+if __name__ == '__main__':
+  unittest.main()
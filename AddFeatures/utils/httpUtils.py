@@ -0,0 +1,85 @@
+import gzip
+import threading
+import requests
+
+from urllib.parse import urlencode
+from requests.adapters import HTTPAdapter
+
+class HttpUtils(object):
+    def __init__(self, http_config=None):
+        http_config = http_config or {}
+
+        self.pool_connections = http_config['pool_connections'] if 'pool_connections' in http_config else 10
+        self.pool_maxsize = http_config['pool_maxsize'] if 'pool_maxsize' in http_config else 20
+        self.timeout = (
+            http_config['connect_timeout'] if 'connect_timeout' in http_config else 10,
+            http_config['read_timeout'] if 'read_timeout' in http_config else 300
+        )
+        self.verify = http_config['verify'] if 'verify' in http_config else False
+
+        # called when a token is rejected (498), so a cached token can be dropped
+        self.on_invalid_token = None
+
+        # one pooled keep-alive session shared by every caller (and thread) in this process
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        if 'keep_alive' in http_config and not http_config['keep_alive']:
+            self.session.headers['Connection'] = 'close'
+
+    def post(self, url, payload, compress=False):
+        if compress:
+            # gzip the url encoded form body
+            headers = {
+                'Content-Type': 'application/x-www-form-urlencoded',
+                'Content-Encoding': 'gzip'
+            }
+            body = gzip.compress(urlencode(payload).encode('utf-8'))
+            return self.session.post(url, data=body, headers=headers, timeout=self.timeout, verify=self.verify)
+        return self.session.post(url, data=payload, timeout=self.timeout, verify=self.verify)
+
+    # post a form payload and return the parsed json response
+    # (if we have an invalid token, drop it from the payload and try again without a token)
+    def post_json(self, url, payload, compress=False):
+        req = self.post(url, payload, compress)
+        req_json = req.json()
+
+        if 'error' in req_json and req_json['error']['code'] == 498 and 'token' in payload:
+            if self.on_invalid_token:
+                self.on_invalid_token()
+            del payload['token']
+            req = self.post(url, payload, compress)
+            req_json = req.json()
+        return req_json
+
+    # requests made and connections opened per host, the difference is how often a connection was reused
+    def get_connection_stats(self):
+        stats = {}
+        adapters = []
+        for adapter in self.session.adapters.values():
+            if adapter not in adapters:
+                adapters.append(adapter)
+
+        for adapter in adapters:
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                host = '{0}://{1}:{2}'.format(pool.scheme, pool.host, pool.port)
+                stats[host] = {
+                    'requests': pool.num_requests,
+                    'connections': pool.num_connections,
+                    'reused': pool.num_requests - pool.num_connections
+                }
+        return stats
+
+HTTP_UTILS = None
+HTTP_UTILS_LOCK = threading.Lock()
+
+# the process wide client, created from the first config it is asked for
+def get_http_utils(http_config=None):
+    global HTTP_UTILS
+    with HTTP_UTILS_LOCK:
+        if HTTP_UTILS is None:
+            HTTP_UTILS = HttpUtils(http_config)
+        return HTTP_UTILS
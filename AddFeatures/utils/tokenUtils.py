@@ -0,0 +1,94 @@
+import os
+import json
+import time
+import tempfile
+
+from utils.lockUtils import file_lock, LockError
+
+class TokenUtils(object):
+    def __init__(self, token_cache_config=None):
+        token_cache_config = token_cache_config or {}
+
+        self.cache_path = os.path.join(tempfile.gettempdir(), 'mesa_gp_tokens.json')
+        if 'path' in token_cache_config and token_cache_config['path']:
+            self.cache_path = token_cache_config['path']
+        self.lock_path = '{}.lock'.format(self.cache_path)
+
+        # refresh tokens this many seconds before they expire
+        self.refresh_margin = 300
+        if 'refresh_margin_seconds' in token_cache_config:
+            self.refresh_margin = token_cache_config['refresh_margin_seconds']
+
+        self.enabled = True
+        if 'enabled' in token_cache_config:
+            self.enabled = token_cache_config['enabled']
+
+    # normalize an expiry to epoch seconds (generateToken returns epoch milliseconds)
+    @staticmethod
+    def normalize_expires(expires=None, expires_in=None):
+        if expires_in is not None:
+            return time.time() + float(expires_in)
+        if expires is None:
+            return None
+        expires = float(expires)
+        if expires > 100000000000:
+            expires = expires / 1000
+        return expires
+
+    def read_tokens(self):
+        try:
+            with open(self.cache_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def write_tokens(self, tokens):
+        now = time.time()
+        tokens = {key: tokens[key] for key in tokens if tokens[key]['expires'] > now}
+
+        temp_path = '{0}.{1}.tmp'.format(self.cache_path, os.getpid())
+        with open(temp_path, 'w') as f:
+            json.dump(tokens, f)
+        if os.name != 'nt':
+            os.chmod(temp_path, 0o600)
+        os.replace(temp_path, self.cache_path)
+
+    # return the cached token for key, or call fetch_token (which returns a (token, expires) pair)
+    # and cache its result. The lock is held while fetching, so concurrent jobs wait for
+    # the one fetch instead of all going to the portal
+    def get_token(self, key, fetch_token):
+        if not self.enabled:
+            return fetch_token()[0]
+
+        try:
+            with file_lock(self.lock_path):
+                tokens = self.read_tokens()
+                if key in tokens and tokens[key]['expires'] - self.refresh_margin > time.time():
+                    return tokens[key]['token']
+
+                token, expires = fetch_token()
+                if token and expires:
+                    tokens[key] = {
+                        'token': token,
+                        'expires': expires
+                    }
+                    try:
+                        self.write_tokens(tokens)
+                    except OSError:
+                        pass
+                return token
+        except LockError:
+            return fetch_token()[0]
+
+    # drop a token the server rejected, so the next request fetches a new one
+    def invalidate(self, key):
+        if not self.enabled:
+            return
+        try:
+            with file_lock(self.lock_path):
+                tokens = self.read_tokens()
+                if key in tokens:
+                    del tokens[key]
+                    self.write_tokens(tokens)
+        except (LockError, OSError):
+            pass
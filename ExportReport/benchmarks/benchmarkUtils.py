@@ -0,0 +1,62 @@
+import arcpy
+import os
+import sys
+import json
+import time
+import tempfile
+
+# the benchmarks import the tool's utils the same way main.py does
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+
+from utils.baseUtils import BaseUtils
+from utils.aprxUtils import AprxUtils
+
+resources_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir, 'resources'))
+
+# a run of the tool in a scratch folder, without reading the GP parameters or touching the real caches
+# ( everything the run writes goes under work_dir )
+def make_aprx_utils(work_dir=None):
+    work_dir = work_dir or tempfile.mkdtemp(prefix='export_report_benchmark_')
+    for folder in ['pdfs', 'lyrx', 'json']:
+        path = os.sep.join([work_dir, folder])
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    with open(os.sep.join([resources_dir, 'config.json'])) as f:
+        config = json.load(f)
+    for cache in ['response_cache', 'tile_cache', 'report_cache', 'page_cache']:
+        config[cache] = {'enabled': False}
+
+    base_utils = BaseUtils.from_state({
+        'in_aoi': None,
+        'in_extent': None,
+        'in_map_type': [],
+        'warning_statements': [],
+        'root_dir': work_dir,
+        'resources_dir': resources_dir,
+        'original_root_dir': work_dir,
+        'output_dir': work_dir,
+        'cur_time': 'benchmark',
+        'cur_date': 'benchmark',
+        'execution_percentage': 0,
+        'page_cnt': 0,
+        'token': None,
+        'report_folder_name': os.path.basename(work_dir),
+        'config': config
+    })
+    arcpy.management.CreateFileGDB(work_dir, '{}.gdb'.format(config['gdb_name']))
+    return AprxUtils(base_utils)
+
+# best of repeat runs of fn, in seconds ( setup runs before each one and is not timed )
+def best_time(fn, repeat=3, setup=None):
+    times = []
+    for idx in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def print_row(*columns):
+    print(''.join(['{:<28}'.format(column) if idx == 0 else '{:>14}'.format(column) for idx, column in enumerate(columns)]))
@@ -0,0 +1,94 @@
+# Compare the two ways a query response becomes a local layer, on synthetic polygon responses:
+# direct ingestion ( one insert cursor, feature layer in memory ) against
+# the JSON file path ( json.dump, JSONToFeatures, then a saved and reloaded lyrx )
+#
+# run with ArcGIS Pro's python: python benchmarks\ingestion.py [feature counts...]
+
+import arcpy
+import os
+import sys
+import json
+import math
+import random
+
+from benchmarkUtils import make_aprx_utils, best_time, print_row
+
+FIELDS = [
+    {'name': 'OBJECTID', 'type': 'esriFieldTypeOID', 'alias': 'OBJECTID'},
+    {'name': 'NAME', 'type': 'esriFieldTypeString', 'alias': 'Name', 'length': 100},
+    {'name': 'CODE', 'type': 'esriFieldTypeInteger', 'alias': 'Code'},
+    {'name': 'ACRES', 'type': 'esriFieldTypeDouble', 'alias': 'Acres'},
+    {'name': 'UPDATED', 'type': 'esriFieldTypeDate', 'alias': 'Updated'}
+]
+
+# a query response of feature_cnt polygons, each a ring of vertex_cnt vertices, like a parcels layer in web mercator
+def make_response(feature_cnt, vertex_cnt=24, seed=0):
+    rand = random.Random(seed)
+    features = []
+    for oid in range(1, feature_cnt + 1):
+        x = -7920000 + rand.uniform(0, 100000)
+        y = 5200000 + rand.uniform(0, 100000)
+        radius = rand.uniform(20, 200)
+        ring = [[round(x + radius * math.cos(2 * math.pi * idx / vertex_cnt), 2), round(y - radius * math.sin(2 * math.pi * idx / vertex_cnt), 2)] for idx in range(vertex_cnt)]
+        ring.append(ring[0])
+        features.append({
+            'attributes': {
+                'OBJECTID': oid,
+                'NAME': 'Parcel {}'.format(oid),
+                'CODE': rand.randint(0, 999),
+                'ACRES': round(math.pi * radius * radius / 4046.8564224, 2),
+                'UPDATED': 1577836800000 + oid * 60000
+            },
+            'geometry': {'rings': [ring]}
+        })
+    return {
+        'objectIdFieldName': 'OBJECTID',
+        'geometryType': 'esriGeometryPolygon',
+        'spatialReference': {'wkid': 102100, 'latestWkid': 3857},
+        'fields': FIELDS,
+        'features': features
+    }
+
+def ingest_direct(aprx_utils, response, shp, feature_name):
+    if not aprx_utils.insert_features_from_json(response, shp):
+        raise RuntimeError('direct ingestion fell back for {}'.format(shp))
+    arcpy.management.MakeFeatureLayer(shp, feature_name)
+
+def ingest_json_file(aprx_utils, response, shp, feature_name):
+    json_file_url = os.sep.join([aprx_utils.base_utils.root_dir, 'json', '{}.json'.format(feature_name)])
+    with open(json_file_url, 'w') as outfile:
+        json.dump(response, outfile)
+    arcpy.JSONToFeatures_conversion(json_file_url, shp)
+    arcpy.management.MakeFeatureLayer(shp, feature_name)
+    lyrx = os.sep.join([aprx_utils.base_utils.root_dir, 'lyrx', '{}.lyrx'.format(feature_name)])
+    arcpy.management.SaveToLayerFile(feature_name, lyrx)
+    arcpy.mp.LayerFile(lyrx)
+
+def main():
+    feature_cnts = [int(arg) for arg in sys.argv[1:]] or [1000, 10000, 50000]
+    aprx_utils = make_aprx_utils()
+    print('work folder: {}'.format(aprx_utils.base_utils.root_dir))
+    print_row('features', 'direct (s)', 'json file (s)', 'speedup')
+
+    for feature_cnt in feature_cnts:
+        response = make_response(feature_cnt)
+        feature_name = 'parcels_{}'.format(feature_cnt)
+        shp = aprx_utils.get_local_source_by_name(feature_name)
+
+        def reset():
+            if arcpy.Exists(feature_name):
+                arcpy.management.Delete(feature_name)
+            if arcpy.Exists(shp):
+                arcpy.management.Delete(shp)
+
+        direct = best_time(lambda: ingest_direct(aprx_utils, response, shp, feature_name), setup=reset)
+        direct_cnt = int(arcpy.management.GetCount(shp)[0])
+        json_file = best_time(lambda: ingest_json_file(aprx_utils, response, shp, feature_name), setup=reset)
+        json_file_cnt = int(arcpy.management.GetCount(shp)[0])
+        if direct_cnt != feature_cnt or json_file_cnt != feature_cnt:
+            raise RuntimeError('expected {0} features, direct wrote {1} and json file {2}'.format(feature_cnt, direct_cnt, json_file_cnt))
+
+        print_row(feature_cnt, '{:.3f}'.format(direct), '{:.3f}'.format(json_file), '{:.1f}x'.format(json_file / direct))
+
+if __name__ == '__main__':
+    main()
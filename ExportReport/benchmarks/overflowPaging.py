@@ -0,0 +1,107 @@
+# Compare the two ways overflow table pages are selected, on synthetic tables of 10k+ rows:
+# rank paging ( page_rank written once, one constant size BETWEEN clause per page ) against
+# object id lists ( one 'objectid IN (...)' clause per page, as get_overflow_clauses built them before )
+# each path is timed building its clauses, then running every page's clause against the source as a render would
+#
+# run with ArcGIS Pro's python: python benchmarks\overflowPaging.py [row counts...]
+
+import arcpy
+import os
+import math
+import random
+import sys
+
+from types import SimpleNamespace
+
+from benchmarkUtils import make_aprx_utils, best_time, print_row
+
+MAX_ROWS = 20
+SORT_FIELD = 'ACRES'
+
+# stand-in layout with the table frame element get_overflow_clauses looks for
+class TableLayout(object):
+    def listElements(self, element_type=None, wildcard=None):
+        return [wildcard]
+
+# a polygon feature class of row_cnt squares with a random acres column to sort on
+def make_table(aprx_utils, row_cnt, seed=0):
+    rand = random.Random(seed)
+    name = 'table_{}'.format(row_cnt)
+    source = aprx_utils.get_local_source_by_name(name)
+    if arcpy.Exists(source):
+        arcpy.management.Delete(source)
+
+    workspace = os.path.split(source)[0]
+    arcpy.management.CreateFeatureclass(workspace, name, 'POLYGON', spatial_reference=arcpy.SpatialReference(3857))
+    arcpy.management.AddFields(source, [['NAME', 'TEXT', 'Name', 100], [SORT_FIELD, 'DOUBLE', 'Acres']])
+    with arcpy.da.InsertCursor(source, ['NAME', SORT_FIELD, 'SHAPE@JSON']) as cursor:
+        for idx in range(row_cnt):
+            x = -7920000 + (idx % 1000) * 100
+            y = 5200000 + (idx // 1000) * 100
+            ring = [[x, y], [x, y + 50], [x + 50, y + 50], [x + 50, y], [x, y]]
+            cursor.insertRow(['Row {}'.format(idx), round(rand.uniform(0, 500), 2), '{{"rings": [{}]}}'.format(ring)])
+    return name, source
+
+# the clauses get_overflow_clauses built before rank paging, one literal per row
+def get_oid_list_clauses(aprx_utils, source, max_rows=MAX_ROWS):
+    oids = aprx_utils.column_utils.get_sorted_oids(source, SORT_FIELD)
+    sub_oids = []
+    for idx, oid in enumerate(oids):
+        try:
+            sub_oids[math.floor(idx/max_rows)].append(str(oid))
+        except IndexError:
+            sub_oids.append([])
+            sub_oids[math.floor(idx/max_rows)].append(str(oid))
+    return ['objectid IN ({})'.format(','.join(sub_oid)) for sub_oid in sub_oids]
+
+def get_rank_clauses(aprx_utils, layer):
+    return aprx_utils.get_overflow_clauses(layer, None, TableLayout(), SORT_FIELD, MAX_ROWS)
+
+# read every page's rows in table order, the query each page render puts to the source
+def read_pages(source, where_clauses):
+    row_cnt = 0
+    for where_clause in where_clauses:
+        with arcpy.da.SearchCursor(source, ['NAME', SORT_FIELD], where_clause) as cursor:
+            for row in cursor:
+                row_cnt += 1
+    return row_cnt
+
+def main():
+    row_cnts = [int(arg) for arg in sys.argv[1:]] or [10000, 50000, 100000]
+    aprx_utils = make_aprx_utils()
+    print('work folder: {}'.format(aprx_utils.base_utils.root_dir))
+    print_row('rows', 'rank build', 'rank pages', 'oid build', 'oid pages', 'speedup')
+
+    for row_cnt in row_cnts:
+        name, source = make_table(aprx_utils, row_cnt)
+        layer = SimpleNamespace(name=name)
+        clauses = {}
+
+        def reset():
+            aprx_utils.invalidate_source_caches(source)
+
+        def build_rank():
+            clauses['rank'] = get_rank_clauses(aprx_utils, layer)
+
+        def build_oid_list():
+            clauses['oid'] = get_oid_list_clauses(aprx_utils, source)
+
+        rank_build = best_time(build_rank, setup=reset)
+        rank_pages = best_time(lambda: read_pages(source, clauses['rank']))
+        oid_build = best_time(build_oid_list, setup=reset)
+        oid_pages = best_time(lambda: read_pages(source, clauses['oid']))
+
+        if read_pages(source, clauses['rank']) != row_cnt or read_pages(source, clauses['oid']) != row_cnt:
+            raise RuntimeError('the pages of {} do not cover every row once'.format(name))
+
+        print_row(
+            row_cnt,
+            '{:.3f}'.format(rank_build),
+            '{:.3f}'.format(rank_pages),
+            '{:.3f}'.format(oid_build),
+            '{:.3f}'.format(oid_pages),
+            '{:.1f}x'.format((oid_build + oid_pages) / (rank_build + rank_pages))
+        )
+
+if __name__ == '__main__':
+    main()
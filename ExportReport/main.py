@@ -9,13 +9,17 @@ resources_dir = 'C:\\Users\\jeff9123\\Documents\\github\\MESA-GP\\ExportReport\\
 utils_dir = 'C:\\Users\\jeff9123\\Documents\\github\\MESA-GP\\ExportReport\\utils'
 
 def try_import():
-    global BaseUtils, AprxUtils
+    global BaseUtils, AprxUtils, ReportCache, RetentionUtils
     from utils import baseUtils
     from utils import aprxUtils
+    from utils import cacheUtils
+    from utils import retentionUtils
     BaseUtils = baseUtils.BaseUtils
     AprxUtils = aprxUtils.AprxUtils
+    ReportCache = cacheUtils.ReportCache
+    RetentionUtils = retentionUtils.RetentionUtils
 
-import sys, os, arcpy
+import sys, os, json, arcpy
 
 try:
     try_import()
@@ -33,6 +37,24 @@ def main():
     if base_utils.sign_into_portal() is None:
         base_utils.add_warning_statement('Could not sign into portal, some layers may not be added')
 
+    # return the report of an identical earlier request straight away
+    report_cache_config = base_utils.config['report_cache'] if 'report_cache' in base_utils.config else {}
+    report_cache = ReportCache(report_cache_config, base_utils.original_root_dir)
+    report_key = None
+    if report_cache.enabled:
+        precision = report_cache_config['coordinate_precision'] if 'coordinate_precision' in report_cache_config else 2
+        report_fingerprint = aprx_utils.get_report_fingerprint(precision)
+        if report_fingerprint:
+            report_key = report_cache.make_key(report_fingerprint)
+            cached_report_url = report_cache.get(report_key)
+            arcpy.AddMessage('REPORT CACHE: {0} ({1} hits, {2} misses)'.format('hit' if cached_report_url else 'miss', *report_cache.get_stats()))
+            if cached_report_url:
+                base_utils.touch_report(cached_report_url)
+                base_utils.check_output_directory()
+                base_utils.increment_execution_percentage(100 - base_utils.execution_percentage)
+                base_utils.set_output(base_utils.get_external_report_url(cached_report_url))
+                return
+
     # Open original base aprx
     aprx_utils.open_aprx()
 
@@ -61,6 +83,10 @@ def main():
     # save the temp pdf
     pdf_doc.saveAndClose() 
 
+    # a report that ran into warnings may be missing data, build it again next time
+    if report_key and not base_utils.warning_statements:
+        report_cache.put(report_key, full_report_url)
+
     # save at the end
     aprx_utils.aprx.save()
 
@@ -72,6 +98,8 @@ def main():
 
     # final cleanup
     base_utils.clean_folder()
+    base_utils.log_connection_stats()
+    aprx_utils.query_utils.log_cache_stats()
 
     # 100%
     base_utils.increment_execution_percentage(3)
@@ -79,6 +107,25 @@ def main():
     # set the external report url to return to user
     base_utils.set_output(external_report_url)
 
+def read_config():
+    with open(os.sep.join([resources_dir, 'config.json'])) as f:
+        return json.load(f)
+
+# drop every cached report ( e.g. after a data load on a service that does not report lastEditDate )
+def clear_report_cache():
+    config = read_config()
+    ReportCache(config['report_cache'] if 'report_cache' in config else None, root_dir).invalidate()
+
+# evict old report folders outside of any job ( e.g. from a scheduled task )
+def sweep_reports():
+    for folder in RetentionUtils(read_config(), root_dir).sweep():
+        print('{}: this folder is currently being used and could not be deleted'.format(folder))
+
 # main
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    if '--clear-report-cache' in sys.argv:
+        clear_report_cache()
+    elif '--sweep' in sys.argv:
+        sweep_reports()
+    else:
+        main()
\ No newline at end of file
@@ -4,11 +4,45 @@ import os
 import json
 import re
 import requests
+import sqlite3
 import time
 import math
 import datetime
+import functools
+import hashlib
+import numpy
+
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from utils.queryUtils import QueryUtils
+from utils.areaUtils import AreaUtils, SQUARE_METERS
+from utils.columnUtils import ColumnUtils
+from utils.cacheUtils import PageCache
+from utils import exportUtils
 
 class AprxUtils(object):
+    # field the table overflow pages are ranged on
+    PAGE_RANK_FIELD = 'page_rank'
+
+    # esri json geometry types and field types the direct ingestion path can write
+    SHAPE_TYPES = {
+        'esriGeometryPoint': 'POINT',
+        'esriGeometryMultipoint': 'MULTIPOINT',
+        'esriGeometryPolyline': 'POLYLINE',
+        'esriGeometryPolygon': 'POLYGON'
+    }
+    FIELD_TYPES = {
+        'esriFieldTypeSmallInteger': 'SHORT',
+        'esriFieldTypeInteger': 'LONG',
+        'esriFieldTypeSingle': 'FLOAT',
+        'esriFieldTypeDouble': 'DOUBLE',
+        'esriFieldTypeString': 'TEXT',
+        'esriFieldTypeDate': 'DATE',
+        'esriFieldTypeGUID': 'GUID',
+        'esriFieldTypeGlobalID': 'GUID'
+    }
+
     def __init__(self, base_utils):
         self.aprx = None
 
@@ -21,13 +55,50 @@ class AprxUtils(object):
         self.aoi_layer = None
         self.aoi_source = None
 
+        # hash of the aoi features, stands in for the aoi layer in page cache keys
+        self.aoi_fingerprint = None
+
         self.original_data_sources = {}
 
         self.new_project_idx = 0
 
+        # bounded pool size for the network queries issued before the arcpy work
+        self.max_query_workers = 6
+        if 'max_query_workers' in base_utils.config:
+            self.max_query_workers = base_utils.config['max_query_workers']
+
+        # write query responses straight into the gdb instead of through json and lyrx files
+        self.direct_ingestion = True
+        if 'direct_ingestion' in base_utils.config:
+            self.direct_ingestion = base_utils.config['direct_ingestion']
+
+        # workspace for the clip/dissolve intermediates, 'memory' or a gdb on a RAM disk
+        # ( empty writes them to the scratch gdb next to the final sources )
+        self.intermediate_workspace = 'memory'
+        if 'intermediate_workspace' in base_utils.config:
+            self.intermediate_workspace = base_utils.config['intermediate_workspace']
+
+        # worker processes for overflow table pages, each renders its pages from one project copy
+        # ( 1 renders them all in this process, still from a single copy )
+        self.overflow_workers = 4
+        if 'overflow_workers' in base_utils.config:
+            self.overflow_workers = base_utils.config['overflow_workers']
+
+        # worker processes for whole layouts, each with its own project copy and report subfolder
+        # ( 1 exports the layouts one after another in this process )
+        self.layout_workers = 1
+        if 'layout_workers' in base_utils.config:
+            self.layout_workers = base_utils.config['layout_workers']
+
         # self.map_finishing_idx = 0
 
         self.base_utils = base_utils
+        self.query_utils = QueryUtils(base_utils)
+        self.area_utils = AreaUtils(base_utils)
+        self.column_utils = ColumnUtils(base_utils)
+
+        page_cache_config = base_utils.config['page_cache'] if 'page_cache' in base_utils.config else None
+        self.page_cache = PageCache(page_cache_config, base_utils.original_root_dir)
         
     def copy_new_project(self, new_project=None):
         if new_project is None and self.new_project_idx == 0:
@@ -107,15 +178,91 @@ class AprxUtils(object):
     def add_layer_to_map_from_json(self, in_json, feature_name, map_obj, position='AUTO_ARRANGE'):
         try:
             feature_name = self.simplify_layer_name(feature_name)
-            json_file_url = os.sep.join([self.base_utils.root_dir, 'json', '{}.json'.format(feature_name)])
-            with open(json_file_url, 'w') as outfile:
-                json.dump(in_json, outfile)
             shp = self.get_local_source_by_name(feature_name)
-            arcpy.JSONToFeatures_conversion(json_file_url, shp)
+            self.invalidate_source_caches(shp)
+            if self.direct_ingestion:
+                with self.base_utils.timed('ingest {}'.format(feature_name)):
+                    inserted = self.insert_features_from_json(in_json, shp)
+                if inserted:
+                    return self.make_layer_from_feature(shp, feature_name, map_obj, position)
+
+            with self.base_utils.timed('ingest {} (JSONToFeatures)'.format(feature_name)):
+                json_file_url = os.sep.join([self.base_utils.root_dir, 'json', '{}.json'.format(feature_name)])
+                with open(json_file_url, 'w') as outfile:
+                    json.dump(in_json, outfile)
+                arcpy.JSONToFeatures_conversion(json_file_url, shp)
             return self.make_lyrx_from_feature(shp, feature_name, map_obj, position)
         except (RuntimeError, TypeError, ValueError):
             self.base_utils.add_warning_statement('WARNING: Could not add layer to map from JSON')
             return None
+
+    # write the features of a query response straight into a new feature class with one insert cursor
+    # (returns False when the response is not something this path handles, so the caller can fall back)
+    def insert_features_from_json(self, in_json, shp):
+        if in_json.get('geometryType') not in self.SHAPE_TYPES or 'fields' not in in_json:
+            return False
+
+        spatial_reference = None
+        if 'spatialReference' in in_json:
+            json_sr = in_json['spatialReference']
+            if 'latestWkid' in json_sr or 'wkid' in json_sr:
+                spatial_reference = arcpy.SpatialReference(json_sr.get('latestWkid', json_sr.get('wkid')))
+            elif 'wkt' in json_sr:
+                spatial_reference = arcpy.SpatialReference()
+                spatial_reference.loadFromString(json_sr['wkt'])
+
+        try:
+            workspace, name = os.path.split(shp)
+            arcpy.management.CreateFeatureclass(
+                workspace,
+                name,
+                self.SHAPE_TYPES[in_json['geometryType']],
+                spatial_reference=spatial_reference
+            )
+
+            existing_fields = [field.name.lower() for field in arcpy.ListFields(shp)]
+            field_names = []
+            date_fields = []
+            new_fields = []
+            for field in in_json['fields']:
+                if field['type'] not in self.FIELD_TYPES or field['name'].lower() in existing_fields:
+                    continue
+                new_field = [field['name'], self.FIELD_TYPES[field['type']], field.get('alias', field['name'])]
+                if field['type'] == 'esriFieldTypeString':
+                    new_field.append(field.get('length', 255))
+                new_fields.append(new_field)
+                field_names.append(field['name'])
+                if field['type'] == 'esriFieldTypeDate':
+                    date_fields.append(field['name'])
+            if new_fields:
+                arcpy.management.AddFields(shp, new_fields)
+
+            with arcpy.da.InsertCursor(shp, field_names + ['SHAPE@JSON']) as cursor:
+                for feature in in_json.get('features', []):
+                    attributes = feature.get('attributes', {})
+                    row = []
+                    for field_name in field_names:
+                        value = attributes.get(field_name)
+                        if value is not None and field_name in date_fields:
+                            value = datetime.datetime(1970, 1, 1) + datetime.timedelta(milliseconds=value)
+                        row.append(value)
+                    geometry = feature.get('geometry')
+                    row.append(json.dumps(geometry) if geometry else None)
+                    cursor.insertRow(row)
+            return True
+        except (RuntimeError, TypeError, ValueError, OverflowError):
+            self.base_utils.add_warning_statement('WARNING: Could not insert features into {}, using JSONToFeatures'.format(shp))
+            return False
+
+    # add a feature class to the map as a feature layer, without saving and reloading a lyrx
+    def make_layer_from_feature(self, shp, feature_name, map_obj, position='AUTO_ARRANGE'):
+        try:
+            feature_layer = arcpy.management.MakeFeatureLayer(shp, feature_name)[0]
+            added_layer = map_obj.addLayer(feature_layer, position)[0]
+            return added_layer
+        except (RuntimeError, TypeError, ValueError):
+            self.base_utils.add_warning_statement('WARNING: Could not make layer for {}'.format(feature_name))
+            return None
     
     def make_lyrx_from_feature(self, shp, feature_name, map_obj, position='AUTO_ARRANGE'):
         try:
@@ -129,7 +276,76 @@ class AprxUtils(object):
             self.base_utils.add_warning_statement('WARNING: Could not make lyrx for {}'.format(feature_name))
             return None
 
-    def make_local_source(self, layer_name, map_obj, url_source):
+    # the input extent buffered by 100%, as [xmin, ymin, xmax, ymax]
+    def get_local_source_envelope(self):
+        buffered_extent = None
+        try: # running from Pro
+            buffered_extent = self.buffer_extent_by_parts(
+                self.base_utils.in_extent.XMin,
+                self.base_utils.in_extent.YMin,
+                self.base_utils.in_extent.XMax,
+                self.base_utils.in_extent.YMax,
+                100
+            )
+        except: # running from Service
+            in_extent_split = self.base_utils.in_extent.split(' ')
+            if len(in_extent_split) >= 4:
+                buffered_extent = self.buffer_extent_by_parts(
+                    float(in_extent_split[0]),
+                    float(in_extent_split[1]),
+                    float(in_extent_split[2]),
+                    float(in_extent_split[3]),
+                    100
+                )
+        return buffered_extent
+
+    # build the query payload for a localized layer
+    def build_local_source_payload(self, buffered_extent=None):
+        envelope_string = None
+        if buffered_extent:
+            envelope_string = '{0},{1},{2},{3}'.format(
+                buffered_extent[0],
+                buffered_extent[1],
+                buffered_extent[2],
+                buffered_extent[3]
+            )
+
+        payload = {
+            'f': 'json',
+            'outFields': '*',
+            'where': '1=1',
+            'inSR': '102100'
+        }
+        if envelope_string:
+            payload['geometry'] = envelope_string
+            payload['geometryType'] = 'esriGeometryEnvelope'
+        if self.base_utils.token:
+            payload['token'] = self.base_utils.token
+        return payload
+
+    # query a localized layer, through the persistent tile cache when it is enabled
+    def query_local_source(self, url_source):
+        buffered_extent = self.get_local_source_envelope()
+        payload = self.build_local_source_payload(buffered_extent)
+        if buffered_extent and self.query_utils.tile_cache.enabled:
+            req_json = self.query_utils.query_by_tiles(url_source, buffered_extent, payload)
+            if req_json is not None:
+                return req_json
+        return self.query_utils.query_all(url_source, payload)
+
+    # query the features of every localized layer that has no local source yet, all at once
+    def prefetch_local_sources(self, localize_layers, map_obj):
+        queries = []
+        for localize_layer in localize_layers:
+            layer = self.get_layer_from_map(localize_layer, map_obj)
+            if layer is None:
+                continue
+            local_source = self.get_local_source_by_name(self.simplify_layer_name(layer.name))
+            if not arcpy.Exists(local_source):
+                queries.append((localize_layer, functools.partial(self.query_local_source, localize_layers[localize_layer])))
+        return self.run_queries(queries)
+
+    def make_local_source(self, layer_name, map_obj, url_source, req_json=None):
         try:
             layer = self.get_layer_from_map(layer_name, map_obj)
             simplified_layer_name = self.simplify_layer_name(layer.name)
@@ -139,61 +355,44 @@ class AprxUtils(object):
                 swapped_layer = self.swap_sources_with_template(layer, local_layer, map_obj)
                 return swapped_layer
 
-            buffered_extent = None
-            try: # running from Pro
-                buffered_extent = self.buffer_extent_by_parts(
-                    self.base_utils.in_extent.XMin,
-                    self.base_utils.in_extent.YMin,
-                    self.base_utils.in_extent.XMax,
-                    self.base_utils.in_extent.YMax,
-                    100
-                )
-            except: # running from Service
-                in_extent_split = self.base_utils.in_extent.split(' ')
-                if len(in_extent_split) >= 4:
-                    buffered_extent = self.buffer_extent_by_parts(
-                        in_extent_split[0],
-                        in_extent_split[1],
-                        in_extent_split[2],
-                        in_extent_split[3],
-                        100
-                    )
-
-            envelope_string = None
-            if buffered_extent:
-                envelope_string = '{0},{1},{2},{3}'.format(
-                    buffered_extent[0],
-                    buffered_extent[1],
-                    buffered_extent[2],
-                    buffered_extent[3]
-                )
+            if req_json is None:
+                req_json = self.query_local_source(url_source)
 
-            payload = {
-                'f': 'json',
-                'outFields': '*',
-                'where': '1=1',
-                'inSR': '102100'
-            }
-            if envelope_string:
-                payload['geometry'] = envelope_string
-                payload['geometryType'] = 'esriGeometryEnvelope'
-            if self.base_utils.token:
-                payload['token'] = self.base_utils.token
-
-            req = requests.post(url_source + '/query', data=payload, verify=False)
-            req_json = req.json()
-
-            if 'error' in req_json and req_json['error']['code'] == 498:
-                del payload['token']
-                req = requests.post(url_source + '/query', data=payload, verify=False)
-                req_json = req.json()
-            
             local_layer = self.add_layer_to_map_from_json(req_json, simplified_layer_name, map_obj)
             swapped_layer = self.swap_sources_with_template(layer, local_layer, map_obj)
             return swapped_layer
         except:
             return None
 
+    # run (key, query function) pairs on a bounded pool of threads and gather the responses by key
+    # (only the network calls run on the pool, arcpy work stays on this thread)
+    def run_queries(self, queries):
+        responses = {}
+        if not queries:
+            return responses
+
+        with ThreadPoolExecutor(max_workers=self.max_query_workers) as executor:
+            futures = []
+            for key, query in queries:
+                futures.append((key, executor.submit(query)))
+
+            for key, future in futures:
+                try:
+                    req_json = future.result()
+                except (requests.exceptions.RequestException, ValueError, sqlite3.Error) as e:
+                    self.base_utils.add_warning_statement('WARNING: Could not query {0}: {1}'.format(key, e))
+                    continue
+                if 'error' in req_json:
+                    self.base_utils.add_warning_statement('WARNING: Could not query {0}: {1}'.format(key, req_json['error']))
+                    continue
+                responses[key] = req_json
+        return responses
+
+    # drop everything computed from a local source that is about to be rewritten
+    def invalidate_source_caches(self, source):
+        self.area_utils.invalidate(source)
+        self.column_utils.invalidate(source)
+
     def get_local_source_by_name(self, name):
         return os.sep.join([self.base_utils.root_dir, '{}.gdb'.format(self.base_utils.config['gdb_name']), name])
 
@@ -205,29 +404,13 @@ class AprxUtils(object):
     def get_layer_count(self, layer):
         source = self.get_layer_source(layer)
         try:
-            count = 0
-            for row in arcpy.da.SearchCursor(source, '*'):
-                count += 1
-            return count
+            return self.column_utils.get_count(source)
         except:
             return 0
 
     def get_all_oids_for_layer(self, layer, aoi, sorting_field=None):
         source = self.get_layer_source(layer)
-        oids = []
-
-        fields = ['objectid']
-        if sorting_field:
-            fields.append(sorting_field)
-
-        for row in arcpy.da.SearchCursor(source, fields):
-            oids.append(row)
-
-        if sorting_field:
-            oids.sort(key=lambda oids: oids[1], reverse=True)
-        oids = map(lambda a: a[0], oids)
-
-        return oids
+        return self.column_utils.get_sorted_oids(source, sorting_field)
 
     def get_layer_from_map(self, name, map_obj):
         for layer in map_obj.listLayers(name):
@@ -250,27 +433,60 @@ class AprxUtils(object):
         source = self.get_layer_source(layer)
         clipped_source = '{} (CLIPPED)'.format(source)
         simplified_clipped_source = self.simplify_layer_name(clipped_source)
-        arcpy.Clip_analysis(source, aoi_layer.dataSource, simplified_clipped_source)
         dissolved_source = '{} (CLIPPED_DISSOLVED)'.format(source)
         simplified_dissolved_source = self.simplify_layer_name(dissolved_source)
-        arcpy.Dissolve_management(
-            simplified_clipped_source,
-            simplified_dissolved_source,
-            dissolve_field,
-            visible_fields,
-            'MULTI_PART' 
-        )
-        for field in visible_fields:
-            arcpy.AlterField_management(
-                simplified_dissolved_source,
-                '{0}_{1}'.format(field[1], field[0]),
-                field[0],
+
+        # clip and dissolve in the intermediate workspace, only the finished source goes to the gdb
+        intermediate_clipped_source = self.get_intermediate_source(simplified_clipped_source)
+        intermediate_dissolved_source = self.get_intermediate_source(simplified_dissolved_source)
+
+        source_name = os.path.basename(source)
+        with self.base_utils.timed('clip {}'.format(source_name)):
+            arcpy.Clip_analysis(source, aoi_layer.dataSource, intermediate_clipped_source)
+        with self.base_utils.timed('dissolve {}'.format(source_name)):
+            arcpy.Dissolve_management(
+                intermediate_clipped_source,
+                intermediate_dissolved_source,
+                dissolve_field,
+                visible_fields,
+                'MULTI_PART' 
             )
+        with self.base_utils.timed('alter fields {}'.format(source_name)):
+            for field in visible_fields:
+                arcpy.AlterField_management(
+                    intermediate_dissolved_source,
+                    '{0}_{1}'.format(field[1], field[0]),
+                    field[0],
+                )
+        self.invalidate_source_caches(simplified_dissolved_source)
+        if intermediate_dissolved_source != simplified_dissolved_source:
+            with self.base_utils.timed('copy {}'.format(source_name)):
+                arcpy.CopyFeatures_management(intermediate_dissolved_source, simplified_dissolved_source)
+            self.delete_intermediate_source(intermediate_dissolved_source)
+        self.delete_intermediate_source(intermediate_clipped_source)
+
         clipped_layer = map_obj.addDataFromPath(simplified_dissolved_source)
         swapped_clipped_layer = self.swap_sources_with_template(layer, clipped_layer, map_obj)
         swapped_clipped_layer.name = '{} (CLIPPED_DISSOLVED)'.format(swapped_clipped_layer.name)
         return swapped_clipped_layer
 
+    # where a throwaway dataset goes: the intermediate workspace if one is configured, else the given gdb path
+    # ( a gdb workspace may be shared by concurrent jobs and layout workers, so its names carry the run and process )
+    def get_intermediate_source(self, source):
+        if not self.intermediate_workspace:
+            return source
+        name = os.path.basename(source)
+        if not self.intermediate_workspace.lower().startswith('memory'):
+            name = '{0}_{1}_{2}'.format(name, self.base_utils.cur_time, os.getpid())
+        return os.sep.join([self.intermediate_workspace, name])
+
+    def delete_intermediate_source(self, source):
+        if self.intermediate_workspace:
+            try:
+                arcpy.Delete_management(source)
+            except RuntimeError:
+                pass
+
     def copy_extent(self, mapframe, extent):
         copy_extent = mapframe.camera.getExtent()
         copy_extent.XMin = extent.XMin
@@ -376,14 +592,90 @@ class AprxUtils(object):
 
         if aoi_layer:
             self.aoi_source = self.get_local_source_by_name(simplified_aoi_layer_name)
-            pre_aoi_source = '{}_PRE'.format(self.aoi_source)
+            pre_aoi_source = self.get_intermediate_source('{}_PRE'.format(self.aoi_source))
            
-            try:
-                aoi_layer.save(pre_aoi_source)
-            except:
-                arcpy.CopyFeatures_management(self.base_utils.in_aoi.dataSource, pre_aoi_source)
+            with self.base_utils.timed('copy aoi'):
+                try:
+                    aoi_layer.save(pre_aoi_source)
+                except:
+                    arcpy.CopyFeatures_management(self.base_utils.in_aoi.dataSource, pre_aoi_source)
             sr = arcpy.SpatialReference(102100)
-            arcpy.Project_management(pre_aoi_source, self.aoi_source, sr)
+            with self.base_utils.timed('project aoi'):
+                arcpy.Project_management(pre_aoi_source, self.aoi_source, sr)
+            self.delete_intermediate_source(pre_aoi_source)
+
+    # everything a finished report depends on, for the report cache
+    # ( None when the aoi can not be read, so the request is not cached )
+    def get_report_fingerprint(self, precision=2):
+        try:
+            aoi_geometries = self.get_normalized_aoi_geometries(precision)
+        except (RuntimeError, TypeError, ValueError, AttributeError):
+            return None
+
+        try: # running from Pro
+            extent = [
+                round(self.base_utils.in_extent.XMin, precision),
+                round(self.base_utils.in_extent.YMin, precision),
+                round(self.base_utils.in_extent.XMax, precision),
+                round(self.base_utils.in_extent.YMax, precision)
+            ]
+        except AttributeError: # running from Service
+            extent = [round(float(part), precision) for part in str(self.base_utils.in_extent).split(' ')[0:4] if part]
+
+        map_types = self.base_utils.in_map_type
+        if isinstance(map_types, str):
+            map_types = [map_types]
+        map_types = sorted([str(map_type) for map_type in map_types])
+
+        # the last edit of every service the selected layouts read, where the service reports it
+        last_edit_dates = {}
+        layouts_config = self.base_utils.config['layouts']
+        for lyt_key in layouts_config:
+            lyt_cfg = layouts_config[lyt_key]
+            if 'map' not in lyt_cfg or lyt_cfg['map'] not in self.base_utils.in_map_type:
+                continue
+            urls = list(lyt_cfg['localize_layers'].values()) if 'localize_layers' in lyt_cfg else []
+            if 'table_layers' in lyt_cfg:
+                urls += [lyr_cfg['source'] for lyr_cfg in lyt_cfg['table_layers'].values()]
+            for url in urls:
+                last_edit_date = self.query_utils.get_last_edit_date(url)
+                if last_edit_date is not None:
+                    last_edit_dates[url] = last_edit_date
+
+        return {
+            'aoi': aoi_geometries,
+            'extent': extent,
+            'map_types': map_types,
+            'config': hashlib.sha256(json.dumps(self.base_utils.config, sort_keys=True).encode('utf-8')).hexdigest(),
+            'last_edit_dates': last_edit_dates
+        }
+
+    # the input aoi's geometries in web mercator, rounded and sorted so the same shape always hashes the same
+    def get_normalized_aoi_geometries(self, precision):
+        aoi = self.base_utils.in_aoi
+        fields = ['SHAPE@JSON']
+        sr = arcpy.SpatialReference(102100)
+        try:
+            cursor = arcpy.da.SearchCursor(aoi, fields, spatial_reference=sr)
+        except (RuntimeError, TypeError):
+            cursor = arcpy.da.SearchCursor(aoi.dataSource, fields, spatial_reference=sr)
+
+        geometries = []
+        with cursor:
+            for row in cursor:
+                geometry = json.loads(row[0])
+                geometry.pop('spatialReference', None)
+                geometries.append(json.dumps(self.round_coordinates(geometry, precision), sort_keys=True))
+        return sorted(geometries)
+
+    def round_coordinates(self, value, precision):
+        if isinstance(value, float):
+            return round(value, precision)
+        if isinstance(value, list):
+            return [self.round_coordinates(item, precision) for item in value]
+        if isinstance(value, dict):
+            return {key: self.round_coordinates(value[key], precision) for key in value}
+        return value
 
     def get_aoi_geometry(self, aoi_layer):
         if 'geometry' not in self.aoi_infos[aoi_layer.name]:
@@ -407,6 +699,39 @@ class AprxUtils(object):
             self.aoi_infos[aoi_layer.name]['geometry'] = aoi_geometry
         return self.aoi_infos[aoi_layer.name]['geometry']
 
+    def get_original_data_source(self, source, url_source):
+        if source.name not in self.original_data_sources:
+            self.original_data_sources[source.name] = url_source
+        return self.original_data_sources[source.name]
+
+    def build_aoi_definition_payload(self, aoi_geometry):
+        payload = {
+            'f': 'json',
+            'outFields': '*',
+            'geometry': json.dumps(aoi_geometry),
+            'geometryType': 'esriGeometryPolygon',
+            'inSR': aoi_geometry['spatialReference']['wkid']
+        }
+        if self.base_utils.token:
+            payload['token'] = self.base_utils.token
+        return payload
+
+    # query every table layer that is not defined yet for this aoi, all at once
+    def prefetch_aoi_definitions(self, aoi_layer, aoi_geometry, map_obj, table_layers):
+        definitions = self.aoi_infos[aoi_layer.name]['definitions']
+        queries = []
+        for layer in table_layers:
+            lyr_cfg = table_layers[layer]
+            source = self.get_layer_from_map(lyr_cfg['name'], map_obj)
+            if source is None or source.name in definitions:
+                continue
+            source_url = self.get_original_data_source(source, lyr_cfg['source'])
+            queries.append((source.name, functools.partial(self.query_utils.query_all, source_url, self.build_aoi_definition_payload(aoi_geometry))))
+
+        responses = self.run_queries(queries)
+        for name in responses:
+            definitions[name] = responses[name]
+
     def set_aoi_definition(self, aoi_layer, aoi_geometry, map_obj, lyr_cfg):
         name = lyr_cfg['name']
         clip = lyr_cfg['clip']
@@ -418,22 +743,8 @@ class AprxUtils(object):
         source = self.get_layer_from_map(name, map_obj)
 
         if source.name not in self.aoi_infos[aoi_layer.name]['definitions']:
-            if source.name not in self.original_data_sources:
-                self.original_data_sources[source.name] = url_source
-            source_url = self.original_data_sources[source.name]
-
-            payload = {
-                'f': 'json',
-                'outFields': '*',
-                'geometry': json.dumps(aoi_geometry),
-                'geometryType': 'esriGeometryPolygon',
-                'inSR': aoi_geometry['spatialReference']['wkid']
-            }
-            if self.base_utils.token:
-                payload['token'] = self.base_utils.token
-
-            req = requests.post(source_url + '/query', data=payload, verify=False)
-            req_json = req.json()
+            source_url = self.get_original_data_source(source, url_source)
+            req_json = self.query_utils.query_all(source_url, self.build_aoi_definition_payload(aoi_geometry))
             self.aoi_infos[aoi_layer.name]['definitions'][source.name] = req_json
 
         filtered_layer = self.add_layer_to_map_from_json(
@@ -464,19 +775,20 @@ class AprxUtils(object):
 
     def replace_acres_and_percent_of_field(self, layer, acres_replace, percent_of_field_replace):
         source = self.get_layer_source(layer)
-        fields = [acres_replace, percent_of_field_replace, 'SHAPE@']
-        total_area = 0
-        with arcpy.da.SearchCursor(source, ['SHAPE@']) as cursor:
-            for row in cursor:
-                total_area += row[0].getArea('GEODESIC', 'ACRES')
+        fields = [acres_replace, percent_of_field_replace, 'OID@']
+        acres_by_oid = self.area_utils.get_areas_by_oid(source, 'ACRES')
+        total_area = self.area_utils.get_total_area(source, 'ACRES')
 
         with arcpy.da.UpdateCursor(source, fields) as cursor:
             for row in cursor:
-                acres = row[2].getArea('GEODESIC', 'ACRES')
+                acres = acres_by_oid[row[2]]
                 row[0] = format(acres, '.2f')
-                row[1] = format(((acres / total_area)*100), '.2f')
+                row[1] = format(((acres / total_area)*100) if total_area else 0, '.2f')
                 cursor.updateRow(row)
 
+        # the acres and percent columns were just rewritten, the geometry was not
+        self.column_utils.invalidate(source)
+
     def set_all_aoi_definitions(self, aoi_layer, aoi_geometry, lyt_cfg):
         if 'definitions' not in self.aoi_infos[aoi_layer.name]:
             self.aoi_infos[aoi_layer.name]['definitions'] = {}
@@ -485,8 +797,15 @@ class AprxUtils(object):
 
         if 'table_layers' in lyt_cfg:
             table_layers = lyt_cfg['table_layers']
+            self.prefetch_aoi_definitions(aoi_layer, aoi_geometry, map_obj, table_layers)
+
+            # then do the local processing in config order, skipping layers whose query failed
+            definitions = self.aoi_infos[aoi_layer.name]['definitions']
             for layer in table_layers:
                 lyr_cfg = table_layers[layer]
+                source = self.get_layer_from_map(lyr_cfg['name'], map_obj)
+                if source is None or source.name not in definitions:
+                    continue
                 self.set_aoi_definition(aoi_layer, aoi_geometry, map_obj, lyr_cfg)
 
     def update_aoi_symbology(self, aoi_layer, lyt_cfg=None):
@@ -532,7 +851,10 @@ class AprxUtils(object):
 
         # simplify the aoi layer name in order to save to lyrx file ( no spaces allowed )
         simplified_aoi_layer_name = self.simplify_layer_name(aoi_layer.name)
-        project_aoi = self.make_lyrx_from_feature(self.aoi_source, simplified_aoi_layer_name, map_obj)
+        if self.direct_ingestion:
+            project_aoi = self.make_layer_from_feature(self.aoi_source, simplified_aoi_layer_name, map_obj)
+        else:
+            project_aoi = self.make_lyrx_from_feature(self.aoi_source, simplified_aoi_layer_name, map_obj)
         aoi_layer = self.swap_sources_with_template(aoi_layer, project_aoi, map_obj)
 
         # add to aoi infos
@@ -542,8 +864,12 @@ class AprxUtils(object):
         # swap to local sources
         if 'localize_layers' in lyt_cfg:
             localize_layers = lyt_cfg['localize_layers']
+            local_source_jsons = self.prefetch_local_sources(localize_layers, map_obj)
             for localize_layer in localize_layers:
-                self.make_local_source(localize_layer, map_obj, localize_layers[localize_layer])
+                if localize_layer in local_source_jsons:
+                    self.make_local_source(localize_layer, map_obj, localize_layers[localize_layer], local_source_jsons[localize_layer])
+                else:
+                    self.make_local_source(localize_layer, map_obj, localize_layers[localize_layer])
 
         # set all aoi definitions for this layout, and set extent to aoi area
         aoi_geometry = self.get_aoi_geometry(aoi_layer)
@@ -583,21 +909,90 @@ class AprxUtils(object):
         # setup execution percentage for each layout
         execution_percentage = 80
         each_execution_percentage = execution_percentage / len(layouts_config)
-        placement_bumper = 0
 
+        lyt_keys = []
         for lyt_key in layouts_config:
             lyt_cfg = layouts_config[lyt_key]
             if 'map' in lyt_cfg and lyt_cfg['map'] in self.base_utils.in_map_type:
-                lyt_name = lyt_cfg['name']
-                placement_bumper = self.export_layout(lyt_name, pdf_doc, lyt_cfg, placement_bumper)
-            self.base_utils.increment_execution_percentage(each_execution_percentage)
+                lyt_keys.append(lyt_key)
+            else:
+                self.base_utils.increment_execution_percentage(each_execution_percentage)
+
+        if self.layout_workers > 1 and len(lyt_keys) > 1:
+            layout_urls = self.export_layouts_in_workers(lyt_keys, each_execution_percentage)
+        else:
+            layout_urls = {}
+            for lyt_key in lyt_keys:
+                lyt_cfg = layouts_config[lyt_key]
+                layout_urls[lyt_key] = self.export_layout(lyt_cfg['name'], lyt_cfg)
+                self.base_utils.increment_execution_percentage(each_execution_percentage)
+
+        # assemble the report in one sequential pass over the page plan
+        with self.base_utils.timed('assemble pdf'):
+            for url in self.plan_pages(lyt_keys, layout_urls):
+                pdf_doc.appendPages(url)
+
+    # final order of every page pdf, worked out up front from the layouts' placements and page counts
+    # ( the same order inserting each page at placement + placement_bumper in config order gave )
+    def plan_pages(self, lyt_keys, layout_urls):
+        layouts_config = self.base_utils.config['layouts']
+
+        page_plan = []
+        placement_bumper = 0
+        for lyt_key in lyt_keys:
+            placement = layouts_config[lyt_key]['placement']
+            for idx, url in enumerate(layout_urls[lyt_key]):
+                if idx > 0:
+                    placement_bumper += 1
+                page_plan.insert(max(placement + placement_bumper - 1, 0), url)
+        return page_plan
+
+    # export each layout in its own worker process, against its own project copy and report subfolder
+    # ( layouts that fail in a worker are exported again in this process )
+    def export_layouts_in_workers(self, lyt_keys, each_execution_percentage):
+        layouts_config = self.base_utils.config['layouts']
+        state = self.base_utils.get_state()
 
-    def export_layout(self, lyt_name, pdf_doc, lyt_cfg, placement_bumper):
+        layout_urls = {}
+        try:
+            with exportUtils.get_process_pool(min(self.layout_workers, len(lyt_keys))) as executor:
+                futures = []
+                for lyt_key in lyt_keys:
+                    lyt_cfg = layouts_config[lyt_key]
+                    worker_dir = os.sep.join([self.base_utils.root_dir, 'layouts', lyt_key])
+                    if not os.path.exists(worker_dir):
+                        os.makedirs(worker_dir)
+                    aprx_url = os.sep.join([worker_dir, '{}_layout.aprx'.format(self.base_utils.config['project_name'])])
+                    self.aprx.saveACopy(aprx_url)
+                    futures.append((lyt_key, executor.submit(
+                        exportUtils.export_layout, state, aprx_url, self.aoi_source, worker_dir, lyt_cfg['name'], lyt_cfg
+                    )))
+
+                for lyt_key, future in futures:
+                    try:
+                        urls, warning_statements = future.result()
+                    except Exception as e:
+                        self.base_utils.add_warning_statement('WARNING: Could not export {0} in a worker: {1}'.format(lyt_key, e))
+                        continue
+                    for warning_statement in warning_statements:
+                        self.base_utils.add_warning_statement(warning_statement)
+                    layout_urls[lyt_key] = urls
+                    self.base_utils.increment_execution_percentage(each_execution_percentage)
+        except (RuntimeError, OSError, BrokenProcessPool) as e:
+            self.base_utils.add_warning_statement('WARNING: Could not export layouts in parallel, exporting in order: {}'.format(e))
+
+        for lyt_key in lyt_keys:
+            if lyt_key not in layout_urls:
+                lyt_cfg = layouts_config[lyt_key]
+                layout_urls[lyt_key] = self.export_layout(lyt_cfg['name'], lyt_cfg)
+                self.base_utils.increment_execution_percentage(each_execution_percentage)
+        return layout_urls
+
+    # export a layout, returning the urls of its page pdfs in page order
+    def export_layout(self, lyt_name, lyt_cfg):
         lyt = self.get_layout_from_aprx(lyt_name)
         aoi_layer = self.set_aoi(lyt, lyt_cfg)
 
-        placement = lyt_cfg['placement']
-
         map_obj = self.get_map_from_lyt_cfg(lyt_cfg)
         
         # add reference layers and labels
@@ -609,17 +1004,24 @@ class AprxUtils(object):
         # add map finishing components
         # self.recreate_map_finishing(map_obj)
 
+        urls = []
+
         # if we have a table layer setup, replace the source, and overflow it if necessary
         if 'table_layers' in lyt_cfg:
             table_layers = lyt_cfg['table_layers']
-            for layer in table_layers:
-                table_layer = table_layers[layer]
+            for table_idx, layer_key in enumerate(table_layers):
+                table_layer = table_layers[layer_key]
                 name = table_layer['name']
                 clip = table_layer['clip']
                 if clip:
                     name = '{} (CLIPPED_DISSOLVED)'.format(name)
                 layer = self.get_layer_from_map(name, map_obj)
 
+                # a table layer that could not be localized has nothing to page through
+                if layer is None or not arcpy.Exists(self.get_layer_source(layer)):
+                    self.base_utils.add_warning_statement('WARNING: Could not find table layer {0} for {1}'.format(name, lyt_name))
+                    continue
+
                 max_rows = None
                 if 'max_table_rows' in lyt_cfg:
                     max_rows = lyt_cfg['max_table_rows']
@@ -631,31 +1033,133 @@ class AprxUtils(object):
                 if max_rows:
                     overflow_clauses = self.get_overflow_clauses(layer, aoi_layer, lyt, sort_field, max_rows)
                 else:
-                    overflow_clauses = self.get_overflow_clauses(layer, aoi_layer, sort_field, lyt)
+                    overflow_clauses = self.get_overflow_clauses(layer, aoi_layer, lyt, sort_field)
 
                 # if we have some overflow clauses
                 if overflow_clauses:
-                    for idx, overflow_clause in enumerate(overflow_clauses): 
-                        if idx > 0:
-                            placement_bumper += 1
-
-                        url = os.sep.join([self.base_utils.root_dir, 'pdfs', '{0}_{1}.pdf'.format(lyt_cfg['map'], idx)])
-                        self.copy_new_project()
-                        map_obj = self.get_map_from_lyt_cfg(lyt_cfg)
-                        layer = self.get_layer_from_map(name, map_obj)
-                        layer.definitionQuery = overflow_clause
-                        lyt = self.get_layout_from_aprx(lyt_name)
-                        lyt.exportToPDF(url)
-                        pdf_doc.insertPages(url, placement + placement_bumper)
-                    layer.definitionQuery = '1=1'
-        else: # export normally
+                    urls += self.export_overflow_pages(lyt_name, lyt_cfg, name, table_idx, overflow_clauses)
+        else: # export normally, unless an earlier report exported this page from the same inputs
             url = os.sep.join([self.base_utils.root_dir, 'pdfs', '{}.pdf'.format(lyt_cfg['map'])])
-            self.copy_new_project()
-            map_obj = self.get_map_from_lyt_cfg(lyt_cfg)
-            lyt = self.get_layout_from_aprx(lyt_name)
-            lyt.exportToPDF(url)
-            pdf_doc.insertPages(url, placement + placement_bumper)
-        return placement_bumper
+            page_key = self.get_layout_fingerprint(lyt, lyt_cfg) if self.page_cache.enabled else None
+            if page_key and self.page_cache.get(page_key, url):
+                arcpy.AddMessage('PAGE CACHE: reused {}'.format(lyt_name))
+            else:
+                self.copy_new_project()
+                map_obj = self.get_map_from_lyt_cfg(lyt_cfg)
+                lyt = self.get_layout_from_aprx(lyt_name)
+                lyt.exportToPDF(url)
+                if page_key:
+                    self.page_cache.put(page_key, url)
+            urls.append(url)
+        return urls
+
+    # key for the page cache from what the layout actually draws: its map extents, layer sources and text
+    # ( the aoi layer is keyed by its features, None when it draws any other data written for a report )
+    def get_layout_fingerprint(self, lyt, lyt_cfg):
+        reports_dir = os.path.normcase(os.sep.join([self.base_utils.original_root_dir, 'reports']))
+        aoi_source = os.path.normcase(self.aoi_source) if self.aoi_source else None
+        map_frames = []
+        for mapframe in lyt.listElements('MAPFRAME_ELEMENT'):
+            extent = mapframe.camera.getExtent()
+            layers = []
+            if mapframe.map:
+                for layer in mapframe.map.listLayers():
+                    if not layer.supports('DATASOURCE'):
+                        layers.append([layer.name, layer.visible])
+                        continue
+                    data_source = layer.dataSource
+                    if aoi_source and os.path.normcase(data_source) == aoi_source:
+                        aoi_fingerprint = self.get_aoi_fingerprint()
+                        if aoi_fingerprint is None:
+                            return None
+                        layers.append([layer.name, layer.visible, 'aoi', aoi_fingerprint])
+                        continue
+                    if os.path.normcase(data_source).startswith(reports_dir) or data_source.lower().startswith('memory'):
+                        return None
+                    definition_query = layer.definitionQuery if layer.supports('DEFINITIONQUERY') else None
+                    last_edit_date = self.query_utils.get_last_edit_date(data_source) if data_source.lower().startswith('http') else None
+                    layers.append([layer.name, layer.visible, data_source, definition_query, last_edit_date])
+            map_frames.append([
+                mapframe.name,
+                mapframe.map.name if mapframe.map else None,
+                [round(extent.XMin, 2), round(extent.YMin, 2), round(extent.XMax, 2), round(extent.YMax, 2)],
+                round(mapframe.camera.scale, 2),
+                layers
+            ])
+
+        texts = sorted([[element.name, element.text] for element in lyt.listElements('TEXT_ELEMENT')])
+
+        # dynamic text ( dates and such ) is only resolved on export, so those pages last a day at most
+        if [text for text in texts if '<dyn' in text[1]]:
+            texts.append(['date', self.base_utils.cur_date])
+
+        # a new template project changes every page
+        template_url = os.sep.join([self.base_utils.resources_dir, '{}.aprx'.format(self.base_utils.config['project_name'])])
+        try:
+            template = [os.path.getmtime(template_url), os.path.getsize(template_url)]
+        except OSError:
+            return None
+
+        return self.page_cache.make_key({
+            'layout': lyt.name,
+            'config': lyt_cfg,
+            'map_frames': map_frames,
+            'texts': texts,
+            'template': template
+        })
+
+    # the same aoi drawn in another report gives the same hash, wherever its source was written
+    # ( None when the aoi source cannot be read )
+    def get_aoi_fingerprint(self):
+        if self.aoi_fingerprint is None:
+            try:
+                with arcpy.da.SearchCursor(self.aoi_source, ['SHAPE@JSON']) as cursor:
+                    shapes = sorted([row[0] or '' for row in cursor])
+            except RuntimeError:
+                return None
+            self.aoi_fingerprint = hashlib.sha256('\n'.join(shapes).encode('utf-8')).hexdigest()
+        return self.aoi_fingerprint
+
+    # export one pdf per overflow clause, contiguous ranges of pages spread over worker processes
+    # ( each worker opens its own project copy once, the urls come back in page order;
+    #   file names carry the table layer's index so the table layers of one map do not overwrite each other )
+    def export_overflow_pages(self, lyt_name, lyt_cfg, layer_name, table_idx, overflow_clauses):
+        pages = []
+        for idx, overflow_clause in enumerate(overflow_clauses):
+            url = os.sep.join([self.base_utils.root_dir, 'pdfs', '{0}_{1}_{2}.pdf'.format(lyt_cfg['map'], table_idx, idx)])
+            pages.append((overflow_clause, url))
+
+        worker_cnt = max(1, min(self.overflow_workers, len(pages)))
+        range_size = math.ceil(len(pages) / worker_cnt)
+        page_ranges = [pages[i:i + range_size] for i in range(0, len(pages), range_size)]
+
+        aprx_urls = []
+        for idx in range(len(page_ranges)):
+            aprx_url = os.sep.join([
+                self.base_utils.root_dir, '{0}_{1}_{2}_overflow_{3}.aprx'.format(
+                    self.base_utils.config['project_name'], lyt_cfg['map'], table_idx, idx
+                )
+            ])
+            self.aprx.saveACopy(aprx_url)
+            aprx_urls.append(aprx_url)
+
+        with self.base_utils.timed('overflow pages {}'.format(lyt_name)):
+            if len(page_ranges) > 1:
+                try:
+                    with exportUtils.get_process_pool(len(page_ranges)) as executor:
+                        futures = []
+                        for aprx_url, page_range in zip(aprx_urls, page_ranges):
+                            futures.append(executor.submit(
+                                exportUtils.export_overflow_pages, aprx_url, lyt_cfg['map'], layer_name, lyt_name, page_range
+                            ))
+                        for future in futures:
+                            future.result()
+                    return [url for overflow_clause, url in pages]
+                except (RuntimeError, OSError, BrokenProcessPool) as e:
+                    self.base_utils.add_warning_statement('WARNING: Could not export overflow pages in parallel, exporting in order: {}'.format(e))
+
+            exportUtils.export_overflow_pages(aprx_urls[0], lyt_cfg['map'], layer_name, lyt_name, pages)
+        return [url for overflow_clause, url in pages]
 
     # def add_optional_layers(self, map_obj):
     #     for layer in self.base_utils.in_optional_layers:
@@ -668,24 +1172,34 @@ class AprxUtils(object):
         except (KeyError, IndexError):
             return None
 
-        # get all of the oids that are currently displaying
+        # get all of the oids that are currently displaying, and rank them in that order in the source
         oids = self.get_all_oids_for_layer(layer, aoi_layer, sort_field)
-        
-        # split them up for each page
-        sub_oids = []
-        for idx, oid in enumerate(oids):
-            try:
-                sub_oids[math.floor(idx/max_rows)].append(str(oid))
-            except IndexError:
-                sub_oids.append([])
-                sub_oids[math.floor(idx/max_rows)].append(str(oid))
-        
+        with self.base_utils.timed('page rank {}'.format(layer.name)):
+            self.write_page_rank(self.get_layer_source(layer), oids)
+
+        # one constant size range of ranks for each page
         where_clauses = []
-        for sub_oid in sub_oids:
-            where_clauses.append('objectid IN ({})'.format(','.join(sub_oid)))
+        for start in range(1, len(oids) + 1, max_rows):
+            where_clauses.append('{0} BETWEEN {1} AND {2}'.format(self.PAGE_RANK_FIELD, start, min(start + max_rows - 1, len(oids))))
 
         return where_clauses
 
+    # write each oid's 1-based position into an indexed rank field of the source, in one extend table pass
+    def write_page_rank(self, source, oids):
+        field_names = [field.name.lower() for field in arcpy.ListFields(source)]
+        if self.PAGE_RANK_FIELD in field_names:
+            arcpy.DeleteField_management(source, self.PAGE_RANK_FIELD)
+
+        ranks = numpy.zeros(len(oids), dtype=[('rank_oid', numpy.int32), (self.PAGE_RANK_FIELD, numpy.int32)])
+        ranks['rank_oid'] = oids
+        ranks[self.PAGE_RANK_FIELD] = numpy.arange(1, len(oids) + 1)
+        arcpy.da.ExtendTable(source, arcpy.Describe(source).OIDFieldName, ranks, 'rank_oid')
+
+        try:
+            arcpy.AddIndex_management(source, self.PAGE_RANK_FIELD, '{}_idx'.format(self.PAGE_RANK_FIELD))
+        except RuntimeError:
+            self.base_utils.add_warning_statement('WARNING: Could not index {0} on {1}'.format(self.PAGE_RANK_FIELD, source))
+
     # replace maps from the layout config as necessary
     def replace_maps(self, lyt, lyt_cfg):
         # replace maps
@@ -755,6 +1269,12 @@ class AprxUtils(object):
         area_unit = self.try_read_replacement_key(replacement_json, 'area_unit')
 
         desc = arcpy.Describe(source)
+        if calculate_property == 'area' and desc.shapeType == 'Polygon' and area_unit and area_unit.upper() in SQUARE_METERS:
+            oids, areas = self.area_utils.get_areas(source)
+            if len(areas):
+                return str(areas[0] / SQUARE_METERS[area_unit.upper()])
+            return ''
+
         with arcpy.da.SearchCursor(source, ['SHAPE@']) as cursor:
             for row in cursor:
                 if calculate_property == 'area' and desc.shapeType == 'Polygon':
@@ -839,18 +1359,18 @@ class AprxUtils(object):
         if 'pixel_size' in replacement_json:
             pixel_size = replacement_json['pixel_size']
         if 'service' in replacement_json:
-            req = requests.post('{0}/{1}'.format(replacement_json['service'], req_type), data=payload, verify=False)
-            req_json = req.json()
-            if 'error' in req_json and req_json['error']['code'] == 498:
-                # if we have an invalid token, try again without a token
-                del payload['token']
-                req = requests.post('{0}/{1}'.format(replacement_json['service'], req_type), data=payload, verify=False)
-                req_json = req.json()
-            while 'error' in req_json and req_json['error']['code'] == 400 and pixel_size:
-                # image exceeded size limit
-                pixel_size *= 2
-                payload['pixelSize'] = '{0},{0}'.format(pixel_size)
-                req = requests.post('{0}/{1}'.format(replacement_json['service'], req_type), data=payload, verify=False)
-                req_json = req.json()
+            replacement_url = '{0}/{1}'.format(replacement_json['service'], req_type)
+
+            def fetch_replacement():
+                nonlocal pixel_size
+                req_json = self.base_utils.http_utils.post_json(replacement_url, payload)
+                while 'error' in req_json and req_json['error']['code'] == 400 and pixel_size:
+                    # image exceeded size limit
+                    pixel_size *= 2
+                    payload['pixelSize'] = '{0},{0}'.format(pixel_size)
+                    req_json = self.base_utils.http_utils.post_json(replacement_url, payload)
+                return req_json
+
+            req_json = self.query_utils.cached_request(replacement_json['service'], req_type, payload, fetch_replacement)
             return self.parse_replacement_response(req_json, replacement_json)
         return ''
\ No newline at end of file
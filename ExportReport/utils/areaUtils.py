@@ -0,0 +1,117 @@
+import arcpy
+import json
+import math
+import numpy
+
+# WGS84 ellipsoid
+SEMI_MAJOR_AXIS = 6378137.0
+FLATTENING = 1 / 298.257223563
+ECCENTRICITY_SQUARED = FLATTENING * (2 - FLATTENING)
+ECCENTRICITY = math.sqrt(ECCENTRICITY_SQUARED)
+
+# square meters in one of each arcpy area unit
+SQUARE_METERS = {
+    'SQUAREMETERS': 1.0,
+    'SQUAREKILOMETERS': 1000000.0,
+    'HECTARES': 10000.0,
+    'ACRES': 4046.8564224,
+    'SQUAREFEET': 0.09290304,
+    'SQUAREYARDS': 0.83612736,
+    'SQUAREMILES': 2589988.110336
+}
+
+def authalic_q(sin_lat):
+    e_sin_lat = ECCENTRICITY * sin_lat
+    return (1 - ECCENTRICITY_SQUARED) * (
+        sin_lat / (1 - e_sin_lat * e_sin_lat) -
+        numpy.log((1 - e_sin_lat) / (1 + e_sin_lat)) / (2 * ECCENTRICITY)
+    )
+
+AUTHALIC_Q_POLE = float(authalic_q(numpy.float64(1.0)))
+AUTHALIC_RADIUS_SQUARED = SEMI_MAJOR_AXIS * SEMI_MAJOR_AXIS * AUTHALIC_Q_POLE / 2
+
+# geodesic areas of every feature in a local source, computed once per source with numpy
+# ( rings are moved onto the authalic sphere, where the area of each edge's spherical excess is summed )
+class AreaUtils(object):
+    def __init__(self, base_utils):
+        self.base_utils = base_utils
+
+        # source -> (object ids, areas in square meters), in cursor order
+        self.areas = {}
+
+    # forget the areas of a source that was rewritten
+    def invalidate(self, source):
+        self.areas.pop(source, None)
+
+    def get_areas(self, source):
+        if source not in self.areas:
+            with self.base_utils.timed('areas {}'.format(source)):
+                self.areas[source] = self.compute_areas(source)
+        return self.areas[source]
+
+    # {object id: area} in the given arcpy area unit
+    def get_areas_by_oid(self, source, unit='ACRES'):
+        oids, areas = self.get_areas(source)
+        areas = areas / SQUARE_METERS[unit]
+        return dict(zip(oids.tolist(), areas.tolist()))
+
+    def get_total_area(self, source, unit='ACRES'):
+        oids, areas = self.get_areas(source)
+        return float(areas.sum()) / SQUARE_METERS[unit]
+
+    def compute_areas(self, source):
+        oids = []
+        lons = []
+        lats = []
+        vertex_features = []
+        vertex_rings = []
+        curve_areas = {}
+
+        ring_idx = 0
+        sr = arcpy.SpatialReference(4326)
+        with arcpy.da.SearchCursor(source, ['OID@', 'SHAPE@JSON'], spatial_reference=sr) as cursor:
+            for row in cursor:
+                feature_idx = len(oids)
+                oids.append(row[0])
+                if not row[1]:
+                    continue
+                geometry = json.loads(row[1])
+                if 'curveRings' in geometry:
+                    # true curves have no vertex list, let arcpy densify them
+                    curve_areas[feature_idx] = arcpy.AsShape(geometry, True).getArea('GEODESIC', 'SQUAREMETERS')
+                    continue
+                for ring in geometry.get('rings', []):
+                    for vertex in ring:
+                        lons.append(vertex[0])
+                        lats.append(vertex[1])
+                    vertex_features.extend([feature_idx] * len(ring))
+                    vertex_rings.extend([ring_idx] * len(ring))
+                    ring_idx += 1
+
+        areas = numpy.zeros(len(oids))
+        if lons:
+            lons = numpy.radians(numpy.array(lons))
+            sin_lats = numpy.sin(numpy.radians(numpy.array(lats)))
+            vertex_features = numpy.array(vertex_features)
+            vertex_rings = numpy.array(vertex_rings)
+
+            # authalic latitude, then the tangent of its half angle for the excess formula
+            authalic_lats = numpy.arcsin(numpy.clip(authalic_q(sin_lats) / AUTHALIC_Q_POLE, -1, 1))
+            tan_half_lats = numpy.tan(authalic_lats / 2)
+
+            # an edge joins consecutive vertices of the same ring
+            same_ring = vertex_rings[:-1] == vertex_rings[1:]
+            delta_lons = numpy.remainder(lons[1:] - lons[:-1] + math.pi, 2 * math.pi) - math.pi
+            tan_sums = tan_half_lats[:-1] + tan_half_lats[1:]
+            tan_products = 1 + tan_half_lats[:-1] * tan_half_lats[1:]
+            excess = 2 * numpy.arctan2(numpy.tan(delta_lons / 2) * tan_sums, tan_products)
+            excess = numpy.where(same_ring, excess, 0)
+
+            # outer rings run clockwise and holes counter-clockwise, so the signed sum per feature is the net area
+            signed = numpy.bincount(vertex_features[:-1], weights=excess, minlength=len(oids))
+            areas = numpy.abs(signed) * AUTHALIC_RADIUS_SQUARED
+
+        for feature_idx in curve_areas:
+            areas[feature_idx] = curve_areas[feature_idx]
+
+        return numpy.array(oids), areas
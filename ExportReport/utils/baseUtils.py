@@ -5,16 +5,20 @@ import ssl
 import re
 import json
 import sys
-import shutil
+import sqlite3
 import smtplib
-import requests
+import time
 
-from operator import itemgetter
+from contextlib import contextmanager
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
 from email import encoders
 
+from utils.tokenUtils import TokenUtils
+from utils.httpUtils import get_http_utils
+from utils.retentionUtils import RetentionUtils
+
 arcpy.env.overwriteOutput = True
 
 class BaseUtils(object):
@@ -45,6 +49,9 @@ class BaseUtils(object):
                 self.config = json.load(f)
         except FileNotFoundError:
             sys.exit()
+
+        # pooled keep-alive client for every REST call the report makes
+        self.http_utils = get_http_utils(self.config['http'] if 'http' in self.config else None)
     
     def set_output(self, report_url):
         arcpy.SetParameter(3, report_url)
@@ -77,6 +84,38 @@ class BaseUtils(object):
         except (RuntimeError, TypeError, ValueError):
             self.add_warning_statement('WARNING: Could not initialize output folder for report')
 
+    # set up the folder of a layout worker ( its own pdfs, json, lyrx and gdb, next to the report's )
+    def initialize_worker_paths(self, worker_dir):
+        for folder in ['pdfs', 'lyrx', 'json']:
+            path = os.sep.join([worker_dir, folder])
+            if not os.path.exists(path):
+                os.makedirs(path)
+        self.root_dir = worker_dir
+        arcpy.management.CreateFileGDB(self.root_dir, '{}.gdb'.format(self.config['gdb_name']))
+
+    # picklable copy of this run for worker processes
+    # ( the aoi parameter and the pooled client stay in this process, the extent goes as plain numbers )
+    def get_state(self):
+        state = dict(self.__dict__)
+        del state['http_utils']
+        state['in_aoi'] = None
+        state['warning_statements'] = []
+        try:
+            state['in_extent'] = [self.in_extent.XMin, self.in_extent.YMin, self.in_extent.XMax, self.in_extent.YMax]
+        except AttributeError:
+            pass
+        return state
+
+    # rebuild a run in a worker process from get_state(), without reading the tool parameters again
+    @classmethod
+    def from_state(cls, state):
+        base_utils = cls.__new__(cls)
+        base_utils.__dict__.update(state)
+        if isinstance(base_utils.in_extent, list):
+            base_utils.in_extent = arcpy.Extent(*base_utils.in_extent)
+        base_utils.http_utils = get_http_utils(base_utils.config['http'] if 'http' in base_utils.config else None)
+        return base_utils
+
     def check_output_directory(self):
         if not self.output_dir:
             self.output_dir = self.root_dir
@@ -88,27 +127,27 @@ class BaseUtils(object):
             if is_gdb:
                 self.output_dir = self.root_dir
 
-    # Clean up folder to only hold the last X reports created
-    # (where X is max_report_buffer in config.json)
+    # Hand the finished report folder to the retention index and evict old reports
+    # (by max_report_buffer in config.json, and the byte and age budgets under retention)
+    # off the request path, unless retention.background is off
     def clean_folder(self):
-        clean_dates = []
-        reports_directory = os.sep.join([self.original_root_dir, 'reports'])
-        for file in os.listdir(reports_directory):
-            try:
-                if file.find('\\') < 0 and file.find('/') < 0 and file.find('.') < 0:
-                    full_dir = os.sep.join([reports_directory, file])
-                    clean_dates.append([os.stat(full_dir).st_mtime, full_dir])
-            except:
-                pass
-
-        sorted(clean_dates, key=itemgetter(0))
-        if len(clean_dates) > self.config['max_report_buffer']:
-            for i in range(0, (len(clean_dates)-self.config['max_report_buffer'])):
-                folder_to_remove = clean_dates[i][1]
-                try:
-                    shutil.rmtree(folder_to_remove)
-                except PermissionError:
+        try:
+            retention_utils = RetentionUtils(self.config, self.original_root_dir)
+            retention_utils.register(self.root_dir)
+            if retention_utils.background:
+                retention_utils.start_sweep(self.root_dir)
+            else:
+                for folder_to_remove in retention_utils.sweep(self.root_dir):
                     self.add_warning_statement(folder_to_remove + ': this folder is currently being used and could not be deleted')
+        except (OSError, sqlite3.Error):
+            self.add_warning_statement('WARNING: Could not clean up the reports folder')
+
+    # mark a cached report as used so retention keeps it, without failing the job that is returning it
+    def touch_report(self, report_url):
+        try:
+            RetentionUtils(self.config, self.original_root_dir).touch(report_url)
+        except (OSError, sqlite3.Error):
+            self.add_warning_statement('WARNING: Could not mark the cached report as used')
 
     def get_external_report_url(self, full_report_url):
         ags_path = os.sep.join(re.split(r'/|\\', self.output_dir)[0:2])
@@ -125,10 +164,21 @@ class BaseUtils(object):
             # Handle target environment that doesn't support HTTPS verification
             ssl._create_default_https_context = _create_unverified_https_context
 
+    # request a new app token from the portal, returns a (token, expires) pair
+    def fetch_app_token(self, portal_url, payload):
+        try:
+            req_json = self.http_utils.post_json(portal_url + '/sharing/rest/oauth2/token', payload)
+            expires_in = req_json['expires_in'] if 'expires_in' in req_json else None
+            return req_json['access_token'], TokenUtils.normalize_expires(expires_in=expires_in)
+        except (ValueError, KeyError):
+            return None, None
+
     def sign_into_portal(self):
         portal_config = self.config['portal']
         portal_url = arcpy.GetActivePortalURL()
+        token_utils = TokenUtils(self.config['token_cache'] if 'token_cache' in self.config else None)
         if 'username' in portal_config and 'password' in portal_config:
+            # not cached, SignInToPortal also signs this arcpy session in for the secured layers in the aprx
             try:
                 portal_info = arcpy.SignInToPortal(
                     portal_url,
@@ -139,30 +189,26 @@ class BaseUtils(object):
             except (ValueError, KeyError):
                 return None
         elif 'app_id' in portal_config and 'refresh_token' in portal_config:
-            try:
-                payload = {
-                    'client_id': portal_config['app_id'],
-                    'refresh_token': portal_config['refresh_token'],
-                    'grant_type': 'refresh_token'
-                }
-
-                req = requests.post(portal_url + '/sharing/rest/oauth2/token', data=payload, verify=False)
-                req_json = req.json()
-                token = req_json['access_token']
-            except (ValueError, KeyError):
+            payload = {
+                'client_id': portal_config['app_id'],
+                'refresh_token': portal_config['refresh_token'],
+                'grant_type': 'refresh_token'
+            }
+            token_key = '{0}|client_id:{1}'.format(portal_url.rstrip('/'), portal_config['app_id'])
+            token = token_utils.get_token(token_key, lambda: self.fetch_app_token(portal_url, payload))
+            self.http_utils.on_invalid_token = lambda: token_utils.invalidate(token_key)
+            if token is None:
                 return None
         elif 'app_id' in portal_config and 'app_secret' in portal_config:
-            try:
-                payload = {
-                    'client_id': portal_config['app_id'],
-                    'client_secret': portal_config['app_secret'],
-                    'grant_type': 'client_credentials'
-                }
-
-                req = requests.post(portal_url + '/sharing/rest/oauth2/token', data=payload, verify=False)
-                req_json = req.json()
-                token = req_json['access_token']
-            except (ValueError, KeyError):
+            payload = {
+                'client_id': portal_config['app_id'],
+                'client_secret': portal_config['app_secret'],
+                'grant_type': 'client_credentials'
+            }
+            token_key = '{0}|client_id:{1}'.format(portal_url.rstrip('/'), portal_config['app_id'])
+            token = token_utils.get_token(token_key, lambda: self.fetch_app_token(portal_url, payload))
+            self.http_utils.on_invalid_token = lambda: token_utils.invalidate(token_key)
+            if token is None:
                 return None
         else:
             infos = arcpy.GetSigninToken()
@@ -174,6 +220,26 @@ class BaseUtils(object):
         self.token = token
         return self.token
 
+    # report how often the pooled client reused a connection instead of a new handshake
+    def log_connection_stats(self):
+        stats = self.http_utils.get_connection_stats()
+        for host in stats:
+            arcpy.AddMessage('{0}: {1} requests over {2} connections ({3} reused)'.format(
+                host,
+                stats[host]['requests'],
+                stats[host]['connections'],
+                stats[host]['reused']
+            ))
+
+    # log how long a stage of the report took, as a TIMING message
+    @contextmanager
+    def timed(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            arcpy.AddMessage('TIMING: {0}: {1:.3f}s'.format(stage, time.perf_counter() - start))
+
     def reset_page_cnt(self):
         self.page_cnt = 0
         self.bookmark_tracker = []
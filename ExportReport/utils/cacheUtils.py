@@ -0,0 +1,470 @@
+import os
+import json
+import math
+import time
+import zlib
+import sqlite3
+import hashlib
+import shutil
+import threading
+
+# canonical hash of a service url, endpoint and payload (without the keys in exclude, the token by default)
+def make_cache_key(url, endpoint, payload, exclude=('token',)):
+    normalized_payload = {}
+    for key in payload:
+        if key not in exclude:
+            normalized_payload[key] = str(payload[key])
+    canonical = json.dumps([url.rstrip('/').lower(), endpoint, normalized_payload], sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+# one connection per call, so the caches are safe to use from the query threads and other jobs
+def connect_cache(path):
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    return conn
+
+def create_cache_dir(path):
+    cache_dir = os.path.dirname(path)
+    if cache_dir and not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+
+class ResponseCache(object):
+    def __init__(self, cache_config, root_dir):
+        cache_config = cache_config or {}
+
+        self.enabled = cache_config['enabled'] if 'enabled' in cache_config else False
+        self.ttl_seconds = cache_config['ttl_seconds'] if 'ttl_seconds' in cache_config else 86400
+        self.max_bytes = cache_config['max_bytes'] if 'max_bytes' in cache_config else 512 * 1024 * 1024
+
+        self.path = os.sep.join([root_dir, 'cache', 'responses.sqlite'])
+        if 'path' in cache_config and cache_config['path']:
+            self.path = cache_config['path']
+
+        self.hits = 0
+        self.misses = 0
+        self.stats_lock = threading.Lock()
+
+        if self.enabled:
+            try:
+                self.create_tables()
+            except (OSError, sqlite3.Error):
+                self.enabled = False
+
+    def connect(self):
+        return connect_cache(self.path)
+
+    def create_tables(self):
+        create_cache_dir(self.path)
+        conn = self.connect()
+        try:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                'key TEXT PRIMARY KEY, '
+                'url TEXT NOT NULL, '
+                'body BLOB NOT NULL, '
+                'size INTEGER NOT NULL, '
+                'created REAL NOT NULL, '
+                'last_access REAL NOT NULL, '
+                'last_edit_date INTEGER)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS responses_by_access ON responses (last_access)')
+        finally:
+            conn.close()
+
+    def make_key(self, url, endpoint, payload):
+        return make_cache_key(url, endpoint, payload)
+
+    def count(self, hit):
+        with self.stats_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    # cached response for key, or None if it is missing, older than the ttl,
+    # or older than the service's last edit
+    def get(self, key, last_edit_date=None):
+        if not self.enabled:
+            return None
+        try:
+            conn = self.connect()
+            try:
+                row = conn.execute('SELECT body, created, last_edit_date FROM responses WHERE key = ?', (key,)).fetchone()
+                now = time.time()
+                if row is None:
+                    self.count(False)
+                    return None
+                if now - row[1] > self.ttl_seconds or (last_edit_date is not None and (row[2] is None or last_edit_date > row[2])):
+                    conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+                    self.count(False)
+                    return None
+                conn.execute('UPDATE responses SET last_access = ? WHERE key = ?', (now, key))
+                self.count(True)
+                return json.loads(zlib.decompress(row[0]).decode('utf-8'))
+            finally:
+                conn.close()
+        except (sqlite3.Error, zlib.error, ValueError):
+            return None
+
+    def put(self, key, url, response, last_edit_date=None):
+        if not self.enabled:
+            return
+        body = zlib.compress(json.dumps(response).encode('utf-8'))
+        now = time.time()
+        try:
+            conn = self.connect()
+            try:
+                conn.execute(
+                    'INSERT OR REPLACE INTO responses (key, url, body, size, created, last_access, last_edit_date) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (key, url, body, len(body), now, now, last_edit_date)
+                )
+                self.evict(conn)
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            pass
+
+    # drop expired responses, then least recently used ones until we are under max_bytes
+    def evict(self, conn):
+        conn.execute('DELETE FROM responses WHERE created < ?', (time.time() - self.ttl_seconds,))
+        total_bytes = conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total_bytes <= self.max_bytes:
+            return
+
+        evict_keys = []
+        for key, size in conn.execute('SELECT key, size FROM responses ORDER BY last_access'):
+            if total_bytes <= self.max_bytes:
+                break
+            evict_keys.append((key,))
+            total_bytes -= size
+        conn.executemany('DELETE FROM responses WHERE key = ?', evict_keys)
+
+    def clear(self):
+        if not self.enabled:
+            return
+        conn = self.connect()
+        try:
+            conn.execute('DELETE FROM responses')
+        finally:
+            conn.close()
+
+# features of a layer stored by fixed grid tile, so overlapping extents reuse what earlier requests fetched
+class TileCache(object):
+    def __init__(self, cache_config, root_dir):
+        cache_config = cache_config or {}
+
+        self.enabled = cache_config['enabled'] if 'enabled' in cache_config else False
+        self.tile_size = cache_config['tile_size'] if 'tile_size' in cache_config else 5000
+        self.ttl_seconds = cache_config['ttl_seconds'] if 'ttl_seconds' in cache_config else 604800
+        self.max_tiles = cache_config['max_tiles_per_request'] if 'max_tiles_per_request' in cache_config else 64
+
+        self.path = os.sep.join([root_dir, 'cache', 'tiles.sqlite'])
+        if 'path' in cache_config and cache_config['path']:
+            self.path = cache_config['path']
+
+        if self.enabled:
+            try:
+                self.create_tables()
+            except (OSError, sqlite3.Error):
+                self.enabled = False
+
+    def connect(self):
+        return connect_cache(self.path)
+
+    def create_tables(self):
+        create_cache_dir(self.path)
+        conn = self.connect()
+        try:
+            conn.execute('CREATE TABLE IF NOT EXISTS layers (layer_key TEXT PRIMARY KEY, metadata TEXT NOT NULL)')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS tiles ('
+                'layer_key TEXT NOT NULL, tile_x INTEGER NOT NULL, tile_y INTEGER NOT NULL, fetched REAL NOT NULL, '
+                'PRIMARY KEY (layer_key, tile_x, tile_y))'
+            )
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS features ('
+                'layer_key TEXT NOT NULL, oid INTEGER NOT NULL, feature TEXT NOT NULL, '
+                'PRIMARY KEY (layer_key, oid))'
+            )
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS tile_features ('
+                'layer_key TEXT NOT NULL, tile_x INTEGER NOT NULL, tile_y INTEGER NOT NULL, oid INTEGER NOT NULL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS tile_features_by_tile ON tile_features (layer_key, tile_x, tile_y)')
+        finally:
+            conn.close()
+
+    # tiles are keyed by the layer and everything in the payload but the geometry and token
+    def make_layer_key(self, url, payload):
+        return make_cache_key(url, 'tiles', payload, ('token', 'geometry', 'geometryType'))
+
+    # the (tile_x, tile_y) range covering an envelope, or None if it needs more than max_tiles
+    def get_tile_range(self, envelope):
+        min_x = int(math.floor(envelope[0] / self.tile_size))
+        min_y = int(math.floor(envelope[1] / self.tile_size))
+        max_x = int(math.floor(envelope[2] / self.tile_size))
+        max_y = int(math.floor(envelope[3] / self.tile_size))
+        if (max_x - min_x + 1) * (max_y - min_y + 1) > self.max_tiles:
+            return None
+        return [min_x, min_y, max_x, max_y]
+
+    def get_tile_envelope(self, tile):
+        return [
+            tile[0] * self.tile_size,
+            tile[1] * self.tile_size,
+            (tile[0] + 1) * self.tile_size,
+            (tile[1] + 1) * self.tile_size
+        ]
+
+    # the tiles in the range that are missing or older than the ttl
+    def get_missing_tiles(self, layer_key, tile_range):
+        conn = self.connect()
+        try:
+            fresh_tiles = set()
+            rows = conn.execute(
+                'SELECT tile_x, tile_y FROM tiles WHERE layer_key = ? AND tile_x BETWEEN ? AND ? AND tile_y BETWEEN ? AND ? AND fetched > ?',
+                (layer_key, tile_range[0], tile_range[2], tile_range[1], tile_range[3], time.time() - self.ttl_seconds)
+            )
+            for row in rows:
+                fresh_tiles.add((row[0], row[1]))
+        finally:
+            conn.close()
+
+        missing_tiles = []
+        for tile_x in range(tile_range[0], tile_range[2] + 1):
+            for tile_y in range(tile_range[1], tile_range[3] + 1):
+                if (tile_x, tile_y) not in fresh_tiles:
+                    missing_tiles.append((tile_x, tile_y))
+        return missing_tiles
+
+    # store the features a tile query returned, replacing what the tile held before
+    def put_tile(self, layer_key, tile, response, oid_field):
+        metadata = {}
+        for key in response:
+            if key not in ['features', 'exceededTransferLimit']:
+                metadata[key] = response[key]
+
+        conn = self.connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('INSERT OR REPLACE INTO layers (layer_key, metadata) VALUES (?, ?)', (layer_key, json.dumps(metadata)))
+            conn.execute('DELETE FROM tile_features WHERE layer_key = ? AND tile_x = ? AND tile_y = ?', (layer_key, tile[0], tile[1]))
+            feature_rows = []
+            tile_feature_rows = []
+            for feature in response['features']:
+                oid = feature['attributes'][oid_field]
+                feature_rows.append((layer_key, oid, json.dumps(feature)))
+                tile_feature_rows.append((layer_key, tile[0], tile[1], oid))
+            conn.executemany('INSERT OR REPLACE INTO features (layer_key, oid, feature) VALUES (?, ?, ?)', feature_rows)
+            conn.executemany('INSERT INTO tile_features (layer_key, tile_x, tile_y, oid) VALUES (?, ?, ?, ?)', tile_feature_rows)
+            conn.execute('INSERT OR REPLACE INTO tiles (layer_key, tile_x, tile_y, fetched) VALUES (?, ?, ?, ?)', (layer_key, tile[0], tile[1], time.time()))
+            conn.execute('COMMIT')
+        except sqlite3.Error:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    # put a query response back together from every feature of the tiles in the range
+    def get_response(self, layer_key, tile_range):
+        conn = self.connect()
+        try:
+            row = conn.execute('SELECT metadata FROM layers WHERE layer_key = ?', (layer_key,)).fetchone()
+            if row is None:
+                return None
+            response = json.loads(row[0])
+            response['features'] = []
+            rows = conn.execute(
+                'SELECT feature FROM features WHERE layer_key = ? AND oid IN ('
+                'SELECT oid FROM tile_features WHERE layer_key = ? AND tile_x BETWEEN ? AND ? AND tile_y BETWEEN ? AND ?'
+                ') ORDER BY oid',
+                (layer_key, layer_key, tile_range[0], tile_range[2], tile_range[1], tile_range[3])
+            )
+            for feature_row in rows:
+                response['features'].append(json.loads(feature_row[0]))
+            return response
+        finally:
+            conn.close()
+
+    # drop tiles past the ttl and the features no tile refers to anymore
+    def evict(self, layer_key):
+        conn = self.connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            stale = conn.execute(
+                'SELECT tile_x, tile_y FROM tiles WHERE layer_key = ? AND fetched <= ?',
+                (layer_key, time.time() - self.ttl_seconds)
+            ).fetchall()
+            for tile in stale:
+                conn.execute('DELETE FROM tile_features WHERE layer_key = ? AND tile_x = ? AND tile_y = ?', (layer_key, tile[0], tile[1]))
+                conn.execute('DELETE FROM tiles WHERE layer_key = ? AND tile_x = ? AND tile_y = ?', (layer_key, tile[0], tile[1]))
+            if stale:
+                conn.execute(
+                    'DELETE FROM features WHERE layer_key = ? AND oid NOT IN (SELECT oid FROM tile_features WHERE layer_key = ?)',
+                    (layer_key, layer_key)
+                )
+            conn.execute('COMMIT')
+        except sqlite3.Error:
+            conn.execute('ROLLBACK')
+        finally:
+            conn.close()
+
+# finished reports by a hash of everything that went into them, so a repeated request gets the existing pdf
+class ReportCache(object):
+    def __init__(self, cache_config, root_dir):
+        cache_config = cache_config or {}
+
+        self.enabled = cache_config['enabled'] if 'enabled' in cache_config else False
+        self.ttl_seconds = cache_config['ttl_seconds'] if 'ttl_seconds' in cache_config else 86400
+
+        self.path = os.sep.join([root_dir, 'cache', 'reports.sqlite'])
+        if 'path' in cache_config and cache_config['path']:
+            self.path = cache_config['path']
+
+        if self.enabled:
+            try:
+                self.create_tables()
+            except (OSError, sqlite3.Error):
+                self.enabled = False
+
+    def connect(self):
+        return connect_cache(self.path)
+
+    def create_tables(self):
+        create_cache_dir(self.path)
+        conn = self.connect()
+        try:
+            conn.execute('CREATE TABLE IF NOT EXISTS reports (key TEXT PRIMARY KEY, report_url TEXT NOT NULL, created REAL NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+            conn.execute("INSERT OR IGNORE INTO stats (name, value) VALUES ('hits', 0), ('misses', 0)")
+        finally:
+            conn.close()
+
+    def make_key(self, fingerprint):
+        canonical = json.dumps(fingerprint, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    # hits and misses are kept with the cache, every run only looks up once
+    def count(self, conn, hit):
+        conn.execute('UPDATE stats SET value = value + 1 WHERE name = ?', ('hits' if hit else 'misses',))
+
+    def get_stats(self):
+        try:
+            conn = self.connect()
+            try:
+                stats = dict(conn.execute('SELECT name, value FROM stats').fetchall())
+                return stats['hits'], stats['misses']
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            return 0, 0
+
+    # path of the cached report for key, or None if it is missing, expired or its pdf is gone
+    def get(self, key):
+        if not self.enabled:
+            return None
+        try:
+            conn = self.connect()
+            try:
+                row = conn.execute('SELECT report_url, created FROM reports WHERE key = ?', (key,)).fetchone()
+                if row is None:
+                    self.count(conn, False)
+                    return None
+                if time.time() - row[1] > self.ttl_seconds or not os.path.exists(row[0]):
+                    conn.execute('DELETE FROM reports WHERE key = ?', (key,))
+                    self.count(conn, False)
+                    return None
+                self.count(conn, True)
+                return row[0]
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            return None
+
+    def put(self, key, report_url):
+        if not self.enabled:
+            return
+        try:
+            conn = self.connect()
+            try:
+                conn.execute('INSERT OR REPLACE INTO reports (key, report_url, created) VALUES (?, ?, ?)', (key, report_url, time.time()))
+                conn.execute('DELETE FROM reports WHERE created < ?', (time.time() - self.ttl_seconds,))
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            pass
+
+    # drop one cached report, or all of them
+    def invalidate(self, key=None):
+        if not self.enabled:
+            return
+        conn = self.connect()
+        try:
+            if key is None:
+                conn.execute('DELETE FROM reports')
+            else:
+                conn.execute('DELETE FROM reports WHERE key = ?', (key,))
+        finally:
+            conn.close()
+
+# exported layout pages by a fingerprint of their inputs, shared by every report run
+class PageCache(object):
+    def __init__(self, cache_config, root_dir):
+        cache_config = cache_config or {}
+
+        self.enabled = cache_config['enabled'] if 'enabled' in cache_config else False
+        self.ttl_seconds = cache_config['ttl_seconds'] if 'ttl_seconds' in cache_config else 604800
+
+        self.path = os.sep.join([root_dir, 'page_cache'])
+        if 'path' in cache_config and cache_config['path']:
+            self.path = cache_config['path']
+
+        if self.enabled:
+            try:
+                if not os.path.exists(self.path):
+                    os.makedirs(self.path, exist_ok=True)
+            except OSError:
+                self.enabled = False
+
+    def make_key(self, fingerprint):
+        canonical = json.dumps(fingerprint, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def get_page_url(self, key):
+        return os.sep.join([self.path, '{}.pdf'.format(key)])
+
+    # copy the stored page for key to url, False if there is none younger than the ttl
+    def get(self, key, url):
+        if not self.enabled:
+            return False
+        page_url = self.get_page_url(key)
+        try:
+            if time.time() - os.path.getmtime(page_url) > self.ttl_seconds:
+                return False
+            shutil.copyfile(page_url, url)
+            return True
+        except OSError:
+            return False
+
+    # store the page at url for key, written aside and renamed so readers never see half a pdf
+    def put(self, key, url):
+        if not self.enabled:
+            return
+        page_url = self.get_page_url(key)
+        temp_url = '{0}.{1}.tmp'.format(page_url, os.getpid())
+        try:
+            shutil.copyfile(url, temp_url)
+            os.replace(temp_url, page_url)
+            self.evict()
+        except OSError:
+            pass
+
+    def evict(self):
+        expired = time.time() - self.ttl_seconds
+        for file in os.listdir(self.path):
+            page_url = os.sep.join([self.path, file])
+            try:
+                if file.endswith('.pdf') and os.path.getmtime(page_url) < expired:
+                    os.remove(page_url)
+            except OSError:
+                pass
@@ -0,0 +1,59 @@
+import arcpy
+import numpy
+
+# values that stand in for nulls when a column is loaded, so they sort after every real value
+NULL_VALUES = {
+    'Double': -numpy.inf,
+    'Single': -numpy.inf,
+    'Integer': numpy.iinfo(numpy.int32).min,
+    'SmallInteger': numpy.iinfo(numpy.int16).min,
+    'String': ''
+}
+
+# columns of the local sources loaded once per run into numpy arrays
+# ( counts and sorted object id orders are served from these instead of new cursors )
+class ColumnUtils(object):
+    def __init__(self, base_utils):
+        self.base_utils = base_utils
+
+        # source -> {field: array}, every array in the same row order as the 'OID@' column
+        self.columns = {}
+
+    # forget the columns of a source that was rewritten
+    def invalidate(self, source):
+        self.columns.pop(source, None)
+
+    def get_columns(self, source, fields=None):
+        if source not in self.columns:
+            self.columns[source] = {}
+        columns = self.columns[source]
+
+        missing_fields = [field for field in ['OID@'] + list(fields or []) if field not in columns]
+        if missing_fields:
+            null_values = {}
+            field_types = {field.name: field.type for field in arcpy.ListFields(source)}
+            for field in missing_fields:
+                if field in field_types and field_types[field] in NULL_VALUES:
+                    null_values[field] = NULL_VALUES[field_types[field]]
+
+            with self.base_utils.timed('columns {}'.format(source)):
+                table = arcpy.da.TableToNumPyArray(source, missing_fields, null_value=null_values)
+            for field in missing_fields:
+                columns[field] = table[field]
+        return columns
+
+    def get_count(self, source):
+        return len(self.get_columns(source)['OID@'])
+
+    # object ids, descending by sort_field when given (ties keep their row order)
+    def get_sorted_oids(self, source, sort_field=None):
+        if not sort_field:
+            return self.get_columns(source)['OID@'].tolist()
+
+        columns = self.get_columns(source, [sort_field])
+        oids = columns['OID@']
+        values = columns[sort_field]
+
+        # a stable ascending sort of the reversed column, reversed again, is a stable descending sort
+        order = numpy.argsort(values[::-1], kind='stable')[::-1]
+        return oids[len(oids) - 1 - order].tolist()
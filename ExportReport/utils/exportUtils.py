@@ -0,0 +1,48 @@
+import arcpy
+import os
+import sys
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor
+
+# pool of separate python processes for arcpy rendering work
+# ( inside Pro or a GP service sys.executable is not python, so spawn the python.exe that ships next to it )
+def get_process_pool(max_workers):
+    context = multiprocessing.get_context('spawn')
+    python_exe = os.path.join(sys.exec_prefix, 'python.exe')
+    if os.path.exists(python_exe):
+        context.set_executable(python_exe)
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=context)
+
+# export overflow pages of a table layout from a single project copy
+# ( pages are (definition query, pdf url) pairs, the project is opened once for all of them )
+def export_overflow_pages(aprx_url, map_name, layer_name, lyt_name, pages):
+    aprx = arcpy.mp.ArcGISProject(aprx_url)
+    layer = aprx.listMaps(map_name)[0].listLayers(layer_name)[0]
+    lyt = aprx.listLayouts(lyt_name)[0]
+
+    urls = []
+    for definition_query, url in pages:
+        layer.definitionQuery = definition_query
+        lyt.exportToPDF(url)
+        urls.append(url)
+
+    del aprx
+    return urls
+
+# export one layout in a worker process, against its own project copy and report subfolder
+# ( returns the page urls and the warnings, for the parent to merge and report )
+def export_layout(state, aprx_url, aoi_source, worker_dir, lyt_name, lyt_cfg):
+    from utils.baseUtils import BaseUtils
+    from utils.aprxUtils import AprxUtils
+
+    base_utils = BaseUtils.from_state(state)
+    base_utils.initialize_worker_paths(worker_dir)
+
+    aprx_utils = AprxUtils(base_utils)
+    aprx_utils.overflow_workers = 1
+    aprx_utils.aoi_source = aoi_source
+    aprx_utils.open_aprx(aprx_url)
+
+    urls = aprx_utils.export_layout(lyt_name, lyt_cfg)
+    return urls, base_utils.warning_statements
@@ -0,0 +1,51 @@
+import os
+import time
+
+from contextlib import contextmanager
+
+if os.name == 'nt':
+    import msvcrt
+else:
+    import fcntl
+
+class LockError(Exception):
+    pass
+
+def try_lock(lock_file):
+    if os.name == 'nt':
+        lock_file.seek(0)
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+    else:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+def unlock(lock_file):
+    if os.name == 'nt':
+        lock_file.seek(0)
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+# exclusive lock shared between processes, held for the duration of the with block
+@contextmanager
+def file_lock(lock_path, timeout=30, poll_interval=0.05):
+    try:
+        lock_file = open(lock_path, 'a+')
+    except OSError as e:
+        raise LockError('Could not open lock {0}: {1}'.format(lock_path, e))
+    try:
+        started = time.time()
+        while True:
+            try:
+                try_lock(lock_file)
+                break
+            except OSError:
+                if time.time() - started > timeout:
+                    raise LockError('Timed out waiting for lock {}'.format(lock_path))
+                time.sleep(poll_interval)
+
+        try:
+            yield
+        finally:
+            unlock(lock_file)
+    finally:
+        lock_file.close()
@@ -0,0 +1,235 @@
+import requests
+import sqlite3
+import threading
+import arcpy
+
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.cacheUtils import ResponseCache, TileCache
+
+class QueryUtils(object):
+    def __init__(self, base_utils):
+        self.base_utils = base_utils
+        self.http_utils = base_utils.http_utils
+
+        self.max_workers = 6
+        if 'max_query_workers' in base_utils.config:
+            self.max_workers = base_utils.config['max_query_workers']
+
+        cache_config = base_utils.config['response_cache'] if 'response_cache' in base_utils.config else {}
+        self.response_cache = ResponseCache(cache_config, base_utils.original_root_dir)
+        self.last_edit_check_services = []
+        if 'last_edit_check_services' in cache_config:
+            self.last_edit_check_services = cache_config['last_edit_check_services']
+
+        tile_config = base_utils.config['tile_cache'] if 'tile_cache' in base_utils.config else {}
+        self.tile_cache = TileCache(tile_config, base_utils.original_root_dir)
+
+        # editingInfo.lastEditDate per service url, looked up at most once per run
+        self.last_edit_dates = {}
+        self.last_edit_dates_lock = threading.Lock()
+
+    # query every feature matching the payload, going to the service only when the cache has no fresh response
+    def query_all(self, url, payload, use_cache=True):
+        if not use_cache:
+            return self.fetch_all(url, payload)
+        return self.cached_request(url, 'query', payload, lambda: self.fetch_all(url, payload))
+
+    # serve a request from the response cache, or call fetch and cache its response
+    def cached_request(self, url, endpoint, payload, fetch):
+        if not self.response_cache.enabled:
+            return fetch()
+
+        last_edit_date = self.get_last_edit_date(url)
+        cache_key = self.response_cache.make_key(url, endpoint, payload)
+        response = self.response_cache.get(cache_key, last_edit_date)
+        if response is not None:
+            return response
+
+        # a response missing pages is used for this report, but never served to another one
+        response = fetch()
+        if 'error' not in response and not response.get('incomplete'):
+            self.response_cache.put(cache_key, url, response, last_edit_date)
+        return response
+
+    # the service's last edit date, for the services configured to invalidate the cache on edits
+    def get_last_edit_date(self, url):
+        if not [service for service in self.last_edit_check_services if url.lower().startswith(service.rstrip('/').lower())]:
+            return None
+
+        with self.last_edit_dates_lock:
+            if url in self.last_edit_dates:
+                return self.last_edit_dates[url]
+
+        payload = {
+            'f': 'json'
+        }
+        if self.base_utils.token:
+            payload['token'] = self.base_utils.token
+
+        last_edit_date = None
+        try:
+            info = self.http_utils.post_json(url, payload)
+            if 'editingInfo' in info and 'lastEditDate' in info['editingInfo']:
+                last_edit_date = info['editingInfo']['lastEditDate']
+        except (requests.exceptions.RequestException, ValueError):
+            pass
+
+        with self.last_edit_dates_lock:
+            self.last_edit_dates[url] = last_edit_date
+        return last_edit_date
+
+    # query an envelope through the tile cache, only the grid tiles that are not cached yet go to the service
+    # (returns None when the envelope covers too many tiles or a tile could not be fetched in full, nothing partial is cached)
+    def query_by_tiles(self, url, envelope, payload):
+        tile_range = self.tile_cache.get_tile_range(envelope)
+        if tile_range is None:
+            return None
+
+        layer_key = self.tile_cache.make_layer_key(url, payload)
+        missing_tiles = self.tile_cache.get_missing_tiles(layer_key, tile_range)
+
+        tile_responses = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = []
+            for tile in missing_tiles:
+                tile_payload = dict(payload)
+                tile_payload['geometry'] = '{0},{1},{2},{3}'.format(*self.tile_cache.get_tile_envelope(tile))
+                tile_payload['geometryType'] = 'esriGeometryEnvelope'
+                futures.append((tile, executor.submit(self.fetch_all, url, tile_payload)))
+
+            for tile, future in futures:
+                try:
+                    tile_response = future.result()
+                except (requests.exceptions.RequestException, ValueError):
+                    return None
+                if 'error' in tile_response or 'features' not in tile_response or tile_response.get('incomplete'):
+                    return None
+                tile_responses.append((tile, tile_response))
+
+        try:
+            for tile, tile_response in tile_responses:
+                oid_field = self.get_oid_field(tile_response)
+                if oid_field is None:
+                    return None
+                self.tile_cache.put_tile(layer_key, tile, tile_response, oid_field)
+            if missing_tiles:
+                self.tile_cache.evict(layer_key)
+            return self.tile_cache.get_response(layer_key, tile_range)
+        except (KeyError, sqlite3.Error):
+            return None
+
+    def get_oid_field(self, response):
+        if 'objectIdFieldName' in response:
+            return response['objectIdFieldName']
+        if 'fields' in response:
+            for field in response['fields']:
+                if field['type'] == 'esriFieldTypeOID':
+                    return field['name']
+        return None
+
+    def log_cache_stats(self):
+        if self.response_cache.enabled:
+            arcpy.AddMessage('RESPONSE CACHE: {0} hits, {1} misses'.format(self.response_cache.hits, self.response_cache.misses))
+
+    # query every feature matching the payload, not just the first maxRecordCount of them
+    # ( a page that could not be fetched marks the response 'incomplete' )
+    def fetch_all(self, url, payload):
+        # the first page is a normal query, most requests fit in it
+        # (the payload is passed as is, so a token dropped on a 498 stays dropped for the pages)
+        first_page = self.http_utils.post_json(url + '/query', payload)
+        if 'error' in first_page or 'exceededTransferLimit' not in first_page or not first_page['exceededTransferLimit']:
+            return first_page
+
+        # the service cut the response off, so get all of the matching object ids
+        ids_payload = dict(payload)
+        ids_payload['returnIdsOnly'] = 'true'
+        ids_json = self.http_utils.post_json(url + '/query', ids_payload)
+        if 'error' in ids_json or 'objectIds' not in ids_json or not ids_json['objectIds']:
+            return self.query_by_offset(url, payload, first_page)
+
+        # and fetch the ones we do not have yet in parallel pages of object ids
+        oid_field = ids_json['objectIdFieldName']
+        received_oids = set()
+        for feature in first_page['features']:
+            oid = self.get_attribute(feature, oid_field)
+            if oid is not None:
+                received_oids.add(oid)
+        remaining_oids = sorted([oid for oid in ids_json['objectIds'] if oid not in received_oids])
+
+        page_size = max(len(first_page['features']), 1)
+        page_payloads = []
+        for idx in range(0, len(remaining_oids), page_size):
+            page_payload = self.build_oid_page_payload(payload, remaining_oids[idx:idx + page_size])
+            page_payloads.append(page_payload)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self.http_utils.post_json, url + '/query', page_payload) for page_payload in page_payloads]
+            for future in futures:
+                try:
+                    page = future.result()
+                except (requests.exceptions.RequestException, ValueError) as e:
+                    page = {'error': {'message': str(e)}}
+                if 'error' in page or 'features' not in page:
+                    self.base_utils.add_warning_statement('WARNING: Could not query every feature from {}, results are incomplete'.format(url))
+                    first_page['incomplete'] = True
+                    continue
+                first_page['features'] += page['features']
+
+        first_page['exceededTransferLimit'] = False
+        return first_page
+
+    # same output fields as the original query, but selecting features by object id only
+    def build_oid_page_payload(self, payload, oids):
+        page_payload = {}
+        for key in payload:
+            if key not in ['geometry', 'geometryType', 'inSR', 'spatialRel', 'where', 'returnIdsOnly', 'resultOffset', 'resultRecordCount']:
+                page_payload[key] = payload[key]
+        page_payload['objectIds'] = ','.join([str(oid) for oid in oids])
+        return page_payload
+
+    # fall back to paging with resultOffset for services that cannot return object ids
+    # ( every page, the first one included, is fetched in the same object id order, so the offsets line up )
+    def query_by_offset(self, url, payload, first_page):
+        page_size = len(first_page['features'])
+        order_by = first_page['objectIdFieldName'] if 'objectIdFieldName' in first_page else None
+        if order_by and page_size:
+            # the first page came back in the service's own order, fetch it again in object id order
+            page = self.http_utils.post_json(url + '/query', self.build_offset_page_payload(payload, 0, page_size, order_by))
+            if 'error' in page or 'features' not in page:
+                self.base_utils.add_warning_statement('WARNING: Could not query every feature from {}, results are incomplete'.format(url))
+                first_page['incomplete'] = True
+                first_page['exceededTransferLimit'] = False
+                return first_page
+            page['objectIdFieldName'] = order_by
+            first_page = page
+        page = first_page
+
+        while 'exceededTransferLimit' in page and page['exceededTransferLimit'] and page['features']:
+            page_payload = self.build_offset_page_payload(payload, len(first_page['features']), page_size, order_by)
+            page = self.http_utils.post_json(url + '/query', page_payload)
+            if 'error' in page or 'features' not in page:
+                self.base_utils.add_warning_statement('WARNING: Could not query every feature from {}, results are incomplete'.format(url))
+                first_page['incomplete'] = True
+                break
+            first_page['features'] += page['features']
+
+        first_page['exceededTransferLimit'] = False
+        return first_page
+
+    def build_offset_page_payload(self, payload, offset, page_size, order_by=None):
+        page_payload = dict(payload)
+        page_payload['resultOffset'] = offset
+        page_payload['resultRecordCount'] = page_size
+        if order_by:
+            page_payload['orderByFields'] = order_by
+        return page_payload
+
+    def get_attribute(self, feature, field_name):
+        attributes = feature['attributes'] if 'attributes' in feature else {}
+        if field_name in attributes:
+            return attributes[field_name]
+        for key in attributes:
+            if key.lower() == field_name.lower():
+                return attributes[key]
+        return None
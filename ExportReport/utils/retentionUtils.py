@@ -0,0 +1,145 @@
+import os
+import time
+import shutil
+import sqlite3
+import threading
+
+from utils.lockUtils import file_lock, LockError
+from utils.cacheUtils import connect_cache, create_cache_dir
+
+def get_folder_size(path):
+    size = 0
+    for folder, sub_folders, files in os.walk(path):
+        for file in files:
+            try:
+                size += os.path.getsize(os.path.join(folder, file))
+            except OSError:
+                pass
+    return size
+
+# index of the report folders with their sizes and last access, evicted least recently used first
+# once the count, byte or age budget is exceeded
+class RetentionUtils(object):
+    def __init__(self, config, root_dir):
+        retention_config = config['retention'] if 'retention' in config else {}
+
+        self.reports_dir = os.sep.join([root_dir, 'reports'])
+        self.max_reports = config['max_report_buffer'] if 'max_report_buffer' in config else None
+        self.max_bytes = retention_config['max_bytes'] if 'max_bytes' in retention_config else None
+        self.max_age_seconds = None
+        if 'max_age_days' in retention_config and retention_config['max_age_days']:
+            self.max_age_seconds = retention_config['max_age_days'] * 86400
+        self.background = retention_config['background'] if 'background' in retention_config else True
+
+        self.path = os.sep.join([root_dir, 'cache', 'retention.sqlite'])
+        if 'path' in retention_config and retention_config['path']:
+            self.path = retention_config['path']
+
+        create_cache_dir(self.path)
+        conn = self.connect()
+        try:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS reports ('
+                'path TEXT PRIMARY KEY, '
+                'size INTEGER NOT NULL, '
+                'last_access REAL NOT NULL)'
+            )
+        finally:
+            conn.close()
+
+    def connect(self):
+        return connect_cache(self.path)
+
+    # report folders live directly in reports/, anything else is not ours to evict
+    def is_report_folder(self, path):
+        return os.path.normcase(os.path.dirname(os.path.abspath(path))) == os.path.normcase(os.path.abspath(self.reports_dir))
+
+    # add a finished report folder to the index
+    def register(self, report_dir):
+        if not self.is_report_folder(report_dir):
+            return
+        conn = self.connect()
+        try:
+            conn.execute(
+                'INSERT OR REPLACE INTO reports (path, size, last_access) VALUES (?, ?, ?)',
+                (os.path.abspath(report_dir), get_folder_size(report_dir), time.time())
+            )
+        finally:
+            conn.close()
+
+    # mark the report folder holding url as used, e.g. when the report cache hands it out again
+    def touch(self, url):
+        url = os.path.normcase(os.path.abspath(url))
+        conn = self.connect()
+        try:
+            for (path,) in conn.execute('SELECT path FROM reports').fetchall():
+                if url.startswith(os.path.normcase(path) + os.sep):
+                    conn.execute('UPDATE reports SET last_access = ? WHERE path = ?', (time.time(), path))
+        finally:
+            conn.close()
+
+    # bring the index in line with the folders on disk
+    # ( folders it has not seen yet are sized once, with their modified time as last access )
+    def sync(self, conn):
+        indexed = set(path for (path,) in conn.execute('SELECT path FROM reports').fetchall())
+        on_disk = set()
+        if os.path.exists(self.reports_dir):
+            for folder in os.listdir(self.reports_dir):
+                path = os.path.abspath(os.sep.join([self.reports_dir, folder]))
+                if os.path.isdir(path):
+                    on_disk.add(path)
+
+        for path in on_disk - indexed:
+            try:
+                conn.execute(
+                    'INSERT OR IGNORE INTO reports (path, size, last_access) VALUES (?, ?, ?)',
+                    (path, get_folder_size(path), os.stat(path).st_mtime)
+                )
+            except OSError:
+                pass
+        conn.executemany('DELETE FROM reports WHERE path = ?', [(path,) for path in indexed - on_disk])
+
+    # evict expired folders, then least recently used ones until the count and byte budgets hold
+    # ( keep is never evicted, it is the report being returned right now; returns the folders that could not be removed )
+    def sweep(self, keep=None):
+        keep = os.path.normcase(os.path.abspath(keep)) if keep else None
+        failed = []
+        try:
+            with file_lock('{}.lock'.format(self.path), timeout=0):
+                conn = self.connect()
+                try:
+                    self.sync(conn)
+                    reports = conn.execute('SELECT path, size, last_access FROM reports ORDER BY last_access').fetchall()
+                    report_cnt = len(reports)
+                    total_bytes = sum([report[1] for report in reports])
+                    expired = time.time() - self.max_age_seconds if self.max_age_seconds else None
+
+                    for path, size, last_access in reports:
+                        over_count = self.max_reports is not None and report_cnt > self.max_reports
+                        over_bytes = self.max_bytes is not None and total_bytes > self.max_bytes
+                        is_expired = expired is not None and last_access < expired
+                        if not (over_count or over_bytes or is_expired):
+                            break
+                        if os.path.normcase(path) == keep:
+                            continue
+                        try:
+                            shutil.rmtree(path)
+                        except FileNotFoundError:
+                            pass
+                        except OSError:
+                            failed.append(path)
+                            continue
+                        conn.execute('DELETE FROM reports WHERE path = ?', (path,))
+                        report_cnt -= 1
+                        total_bytes -= size
+                finally:
+                    conn.close()
+        except (LockError, sqlite3.Error):
+            pass
+        return failed
+
+    # sweep off the request path, in a thread that is allowed to finish after the job returns
+    def start_sweep(self, keep=None):
+        thread = threading.Thread(target=self.sweep, args=(keep,), daemon=False)
+        thread.start()
+        return thread